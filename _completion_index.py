@@ -0,0 +1,274 @@
+#
+# Sublime Text plugin to support Solar2D Editor
+#
+# Copyright (c) 2020 Solar2D.
+#
+# MIT License - see https://raw.github.com/coronalabs/CoronaSDK-SublimeText/master/LICENSE
+
+# In-memory index of a completions docset so that each keystroke only has to look at the
+# completions which could possibly match rather than the whole list.
+#
+# The index is built from the API entries in a docset's corona.api-* file, which say what each
+# completion is (see gen_completions/mk_sublime_completions.py), or from the triggers and contents
+# in a Sublime completions file if there isn't one.
+#
+# Note: this module doesn't use the Sublime Text API so it can be loaded outside the editor (it's
+# used by gen_completions/mk_completions_index.py to build the prebuilt index shipped with each docset)
+
+import array
+import bisect
+import hashlib
+import pickle
+import re
+import sys
+import zlib
+
+try:
+  intern_string = sys.intern  # P3
+except AttributeError:
+  # P2 (intern() only takes byte strings and JSON gives us unicode)
+  def intern_string(s):
+    return intern(s) if isinstance(s, str) else s
+
+
+# The prebuilt index for a docset lives in a file named after the docset with this suffix
+INDEX_SUFFIX = ".idx"
+
+# Version of the prebuilt index data, change this if the CompletionIndex attributes change
+INDEX_FORMAT = 4
+
+# Version of the corona.api-* files, change this if the API entries change
+API_FORMAT = 1
+
+# The kinds of API entry
+FUNCTION = "function"
+METHOD = "method"
+PROPERTY = "property"
+_kinds = {FUNCTION: FUNCTION, METHOD: METHOD, PROPERTY: PROPERTY}
+
+_findWhiteSpace = re.compile("([^,])\s")
+
+
+# determine if 'obj' is a string in both Python 2.x and 3.x
+def is_string_instance(obj):
+  try:
+    return isinstance(obj, basestring)
+  except NameError:
+    return isinstance(obj, str)
+
+
+# Remove white space from a completion, e.g.
+#   display.capture( displayObject [, saveToPhotoLibrary ] )
+# becomes
+#   display.capture(displayObject[, saveToPhotoLibrary])
+def strip_white_space(contents):
+  return _findWhiteSpace.sub("\\1", contents)
+
+
+# "display.newText()" -> "display", "newText()" -> ""
+def namespace_of(name):
+  if "." not in name:
+    return ""
+  return name.partition(".")[0]
+
+
+# How an API entry is called, e.g. "display.newText( options )" or
+# "VectorObject:setFillColor( gray, [alpha] )"
+def signature_of(entry):
+  args = ", ".join(arg["name"] if not arg["optional"] else "[" + arg["name"] + "]" for arg in entry["args"])
+  name = entry["name"] if entry["kind"] != METHOD else (entry["type"] or "object") + ":" + entry["name"]
+  return name + ("( " + args + " )" if args else "()")
+
+
+# A compact array of completion ids
+def id_array(ids):
+  return array.array('i', ids)
+
+
+# Split a sorted list of (key, id) into a list of the keys (for bisecting) and an array of the ids
+def split_keys(pairs):
+  pairs.sort()
+  return ([key for key, cid in pairs], id_array(cid for key, cid in pairs))
+
+
+class CompletionIndex(object):
+
+  # Everything needed to recreate an index without rebuilding it
+  _state = ("triggers", "contents", "stripped", "names", "descriptions", "kinds", "signatures",
+            "_sorted", "_namespaces", "_chars", "_lower", "_calls")
+
+  def __init__(self, completions=()):
+    # Parallel arrays of interned strings, the position in these is the id of a completion
+    self.triggers = []
+    self.contents = []
+    self.stripped = []  # contents without white space (see "corona_sdk_completions_strip_white_space")
+    self.names = []
+    self.descriptions = []
+    # FUNCTION, METHOD, PROPERTY and how functions are called (None if we don't know, i.e. the
+    # completion didn't come from an API entry)
+    self.kinds = []
+    self.signatures = []
+
+    # Sorted names and the ids they belong to, (names, ids), for the whole docset and for each
+    # namespace ("display", "audio", ...)
+    self._sorted = []
+    self._namespaces = {}
+
+    # Every character mapped to the ids of completions whose trigger contains it
+    self._chars = {}
+
+    # Sorted lowercase triggers and their ids for looking up snippets (see find_trigger())
+    self._lower = []
+
+    # Function names ("display.newText") and method names (":setFillColor") mapped to the ids of
+    # their completions (see signatures_for())
+    self._calls = {}
+
+    # ST completion files contain an array that is a mixture of strings and dicts, API entries
+    # are dicts with a name
+    for c in completions:
+      if isinstance(c, dict):
+        if 'name' in c:
+          self.add_entry(c)
+        else:
+          self.add(c['trigger'], c['contents'])
+      elif is_string_instance(c):
+        self.add(c, c)
+
+    # (the ids are kept in arrays rather than lists of ints and tuples to keep the index small)
+    self._sorted = split_keys(self._sorted)
+    self._lower = split_keys(self._lower)
+    for ns in self._namespaces:
+      self._namespaces[ns] = split_keys(self._namespaces[ns])
+    for ch in self._chars:
+      self._chars[ch] = id_array(self._chars[ch])
+    for call in self._calls:
+      self._calls[call] = id_array(self._calls[call])
+
+  def __len__(self):
+    return len(self.triggers)
+
+  def add(self, trigger, contents):
+    # The completion name is the trigger without the description which follows the tab
+    name, tab, description = trigger.partition("\t")
+    self.append(trigger, contents, name, namespace_of(name), description, None, None)
+
+  # Add an API entry, everything we need is in the entry so the trigger isn't looked at
+  def add_entry(self, entry):
+    kind = _kinds[entry['kind']]
+    name = entry['name'] if kind == PROPERTY else entry['name'] + "()"
+    signature = signature_of(entry) if kind != PROPERTY else None
+    cid = self.append(entry['trigger'], entry['contents'], name, entry['namespace'], entry['type'] or "", kind, signature)
+    if kind != PROPERTY:
+      self._calls.setdefault(entry['name'] if kind == FUNCTION else ":" + entry['name'], []).append(cid)
+
+  def append(self, trigger, contents, name, ns, description, kind, signature):
+    cid = len(self.triggers)
+    trigger = intern_string(trigger)
+    name = intern_string(name)
+    self.triggers.append(trigger)
+    self.contents.append(intern_string(contents))
+    self.stripped.append(intern_string(strip_white_space(contents)))
+    self.names.append(name)
+    self.descriptions.append(intern_string(description))
+    self.kinds.append(kind)
+    self.signatures.append(signature)
+
+    self._sorted.append((name, cid))
+    if ns:
+      self._namespaces.setdefault(ns, []).append((name, cid))
+
+    for ch in set(trigger):
+      self._chars.setdefault(ch, []).append(cid)
+
+    self._lower.append((trigger.lower(), cid))
+    return cid
+
+  def state(self):
+    return dict((name, getattr(self, name)) for name in self._state)
+
+  @classmethod
+  def from_state(cls, state):
+    index = cls.__new__(cls)
+    for name in cls._state:
+      setattr(index, name, state[name])
+    return index
+
+  def namespace(self, ns):
+    return list(self._namespaces[ns][1]) if ns in self._namespaces else []
+
+  # ids of completions whose trigger starts with 'prefix' (the equivalent of testing each
+  # trigger with startswith() as the prefix can't contain the tab before the description)
+  def prefix(self, prefix):
+    keys, keyIds = self._namespaces.get(namespace_of(prefix), self._sorted)
+    ids = []
+    i = bisect.bisect_left(keys, prefix)
+    while i < len(keys) and keys[i].startswith(prefix):
+      ids.append(keyIds[i])
+      i += 1
+    return ids
+
+  # id of the first completion whose trigger starts with 'text' ignoring case (None if there isn't one),
+  # this is how the snippets in the menu, which are just the text of a completion, are found
+  def find_trigger(self, text):
+    text = text.lower()
+    keys, ids = self._lower
+    i = bisect.bisect_left(keys, text)
+    found = None
+    while i < len(keys) and keys[i].startswith(text):
+      if found is None or ids[i] < found:
+        found = ids[i]
+      i += 1
+    return found
+
+  # How the function (e.g. "display.newText") or method (e.g. "image:setFillColor") 'call' can be
+  # called, one signature for each way it's documented
+  def signatures_for(self, call):
+    if ":" in call:
+      call = ":" + call.rpartition(":")[2]
+    return [self.signatures[cid] for cid in self._calls.get(call, ())]
+
+  # ids of completions whose trigger contains every character in 'pattern' which is a
+  # precondition for fuzzily matching it (the candidates still need to be scored)
+  def fuzzy_candidates(self, pattern):
+    if pattern == "":
+      return list(range(len(self.triggers)))
+
+    buckets = []
+    for ch in set(pattern):
+      bucket = self._chars.get(ch)
+      if bucket is None:
+        return []
+      buckets.append(bucket)
+
+    # Start with the rarest character and narrow from there
+    buckets.sort(key=len)
+    candidates = set(buckets[0])
+    for bucket in buckets[1:]:
+      candidates.intersection_update(bucket)
+      if not candidates:
+        break
+
+    return sorted(candidates)
+
+
+# Identifies the docset an index was built from so a stale index isn't used
+def source_digest(source_bytes):
+  return hashlib.md5(source_bytes).hexdigest()
+
+
+# Serialize an index built from the docset 'source_bytes' (the contents of a corona.api-* file)
+def dump_index(index, source_bytes):
+  state = index.state()
+  state['format'] = INDEX_FORMAT
+  state['source'] = source_digest(source_bytes)
+  return zlib.compress(pickle.dumps(state, 2), 9)
+
+
+# Recreate an index serialized by dump_index(), returns None if it's in an old format or wasn't
+# built from 'source_bytes'
+def load_index(data, source_bytes):
+  state = pickle.loads(zlib.decompress(data))
+  if state.get('format') != INDEX_FORMAT or state.get('source') != source_digest(source_bytes):
+    return None
+  return CompletionIndex.from_state(state)
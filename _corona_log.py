@@ -0,0 +1,158 @@
+#
+# Sublime Text plugin to support Solar2D Editor
+#
+# Copyright (c) 2020 Solar2D.
+#
+# MIT License - see https://raw.github.com/coronalabs/CoronaSDK-SublimeText/master/LICENSE
+
+# Logging for the package's modules.  The level is checked before anything is formatted and
+# messages take %-style arguments which are only formatted if the message is going to be logged.
+# Messages are formatted, printed to the console and written to debug.log by a background thread
+# so logging doesn't slow down the thread doing it (often the UI thread).
+#
+# Note: this module doesn't use the Sublime Text API, _corona_utils sets the level from the
+# "corona_sdk_debug" setting and tells us where debug.log goes
+
+import os
+import time
+import datetime
+import threading
+import traceback
+
+try:
+  import queue  # P3
+  logQueue = queue
+except:
+  import Queue  # P2
+  logQueue = Queue
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+# When debug.log gets bigger than this it's renamed to debug.log.1 (replacing any previous one)
+# and a new one is started
+LOG_MAX_BYTES = 2 * 1024 * 1024
+
+_level = INFO
+_logFile = None  # path of debug.log (None until we know where it goes)
+_queue = logQueue.Queue()
+_writer = None
+_writerLock = threading.Lock()
+
+
+def setLevel(level):
+  global _level
+  _level = level
+
+
+def isEnabledFor(level):
+  return level >= _level
+
+
+def setLogFile(path):
+  global _logFile
+  _logFile = path
+
+
+def log(level, msg, *args):
+  if level >= _level:
+    _enqueue(msg, args, None)
+
+
+def debug(msg, *args):
+  if DEBUG >= _level:
+    _enqueue(msg, args, None)
+
+
+# Log 'msg' followed by the stack of the caller (which is formatted by the writer)
+def stacktrace(msg, *args):
+  if DEBUG >= _level:
+    _enqueue(msg, args, traceback.extract_stack()[:-1])
+
+
+def _enqueue(msg, args, stack):
+  global _writer
+  _queue.put((time.time(), threading.current_thread().name, msg, args, stack))
+  if _writer is None:
+    with _writerLock:
+      if _writer is None:
+        _writer = LogWriter()
+        _writer.start()
+
+
+# Formats the queued messages and writes them out, everything waiting in the queue is written
+# before debug.log is flushed
+class LogWriter(threading.Thread):
+
+  def __init__(self):
+    threading.Thread.__init__(self, name="CoronaLogWriter")
+    self.daemon = True
+    self.fd = None
+    self.path = None
+
+  def run(self):
+    while True:
+      records = [_queue.get()]
+      while True:
+        try:
+          records.append(_queue.get_nowait())
+        except logQueue.Empty:
+          break
+      lines = []
+      for record in records:
+        lines.extend(self.format(*record))
+      print("\n".join("Corona Editor: " + line for line in lines))
+      self.write(lines)
+
+  def format(self, when, threadName, msg, args, stack):
+    if args:
+      try:
+        msg = msg % args
+      except (TypeError, ValueError):
+        msg = " ".join([str(msg)] + [str(arg) for arg in args])
+    prefix = str(datetime.datetime.fromtimestamp(when)) + " (" + threadName + "): "
+    lines = [prefix + str(msg)]
+    if stack is not None:
+      for line in traceback.format_list(stack):
+        lines.append(prefix + "    " + line.strip())
+    return lines
+
+  def write(self, lines):
+    try:
+      if self.path != _logFile:
+        self.open(_logFile)
+      if self.fd is None:
+        return
+      self.fd.write("\n".join(lines) + "\n")
+      self.fd.flush()
+      if self.fd.tell() > LOG_MAX_BYTES:
+        self.rotate()
+    except (IOError, OSError) as e:
+      print("Corona Editor: error writing debug log: " + str(e))
+      self.close()
+
+  def open(self, path):
+    self.close()
+    self.path = path
+    if path is None:
+      return
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    # each session starts a new log
+    self.fd = open(path, "w")
+
+  def rotate(self):
+    self.close()
+    backup = self.path + ".1"
+    if os.path.exists(backup):
+      os.remove(backup)
+    os.rename(self.path, backup)
+    self.fd = open(self.path, "w")
+
+  def close(self):
+    if self.fd is not None:
+      self.fd.close()
+      self.fd = None
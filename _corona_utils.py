@@ -10,6 +10,7 @@
 # again when it comes up in the load order)
 
 import sublime
+import sublime_plugin
 import os
 import re
 import threading
@@ -17,6 +18,11 @@ import io
 import subprocess
 import sys
 
+try:
+  from . import _corona_log  # P3
+except:
+  import _corona_log  # P2
+
 # Define "check_output" for Python <= 2.6 (ST2 uses this)
 if "check_output" not in dir( subprocess ):
   def f(*popenargs, **kwargs):
@@ -39,36 +45,113 @@ PACKAGE_NAME = "not set"
 PACKAGE_DIR = "not set"
 PACKAGE_USER_DIR = "not set"
 ST_PACKAGE_PATH = "not set"
-_corona_sdk_debug = False
 
 # In Sublime Text 3 most APIs are unavailable until a module level function is called (fortunately
 # sublime.version() is available so we can correctly fake things in Sublime Text 2; see about.py)
 SUBLIME_VERSION = 3000 if sublime.version() == '' else int(sublime.version())
 
 
+# The package's settings and the values used if they aren't set anywhere
+SETTING_DEFAULTS = {
+  "corona_sdk_debug": False,
+  "corona_sdk_completion": True,
+  "corona_sdk_use_docset": "public",
+  "corona_sdk_use_fuzzy_completion": True,
+  "corona_sdk_completions_strip_white_space": False,
+  "corona_sdk_complete_periods": True,
+  "corona_sdk_signature_help": True,
+  "corona_sdk_autocomplete_extensions": [],
+  "corona_sdk_follow_symlinks": False,
+  "corona_sdk_default_new_file_to_corona_lua": True,
+  "corona_sdk_auto_build": False,
+  "corona_sdk_version": None,
+  "corona_sdk_simulator_path": None,
+  "corona_sdk_simulator_show_console": False,
+  "corona_sdk_debugger_console_max_lines": 5000,
+}
+
+
+# The current value of each of the package's settings as an attribute, e.g. Settings.corona_sdk_use_docset
+#
+# The values are read when the settings change (we're told about changes to the Corona Editor settings,
+# the Sublime Text preferences and the settings of the active view) rather than each time they're used.
+# This means they can be read cheaply on every keystroke and safely from any thread (reading settings
+# in some threads locks up Sublime Text).
+class SettingsSnapshot(object):
+
+  _onChangeKey = "corona_editor_settings"
+
+  def __init__(self):
+    self._viewSettings = None
+    self.__dict__.update(SETTING_DEFAULTS)
+
+  # Start listening for changes (once the Sublime Text API is ready)
+  def load(self):
+    for name in ['Corona Editor.sublime-settings', 'Preferences.sublime-settings']:
+      sublime.load_settings(name).add_on_change(self._onChangeKey, self.refresh)
+    window = sublime.active_window()
+    if window is not None and window.active_view() is not None:
+      self.setActiveView(window.active_view())
+    else:
+      self.refresh()
+
+  def setActiveView(self, view):
+    settings = view.settings()
+    if self._viewSettings is not None:
+      self._viewSettings.clear_on_change(self._onChangeKey)
+    settings.add_on_change(self._onChangeKey, self.refresh)
+    self._viewSettings = settings
+    self.refresh()
+
+  def refresh(self):
+    settings = sublime.load_settings('Corona Editor.sublime-settings')
+    values = {}
+    for key, default in SETTING_DEFAULTS.items():
+      # A value in the view's settings (which include the Sublime Text preferences and the project's settings)
+      # overrides the Corona Editor settings, which set most of these, then we use the default.  Values like
+      # false and 0 are real values so only a missing setting is looked for elsewhere.
+      value = self._viewSettings.get(key) if self._viewSettings is not None else None
+      if value is None:
+        value = settings.get(key)
+      values[key] = value if value is not None else default
+    self.__dict__.update(values)
+    _corona_log.setLevel(_corona_log.DEBUG if self.corona_sdk_debug else _corona_log.INFO)
+
+
+Settings = SettingsSnapshot()
+
+
+class SettingsSnapshotListener(sublime_plugin.EventListener):
+
+  def on_activated(self, view):
+    Settings.setActiveView(view)
+
+
+# Prefer reading Settings directly, this is for settings which aren't in SETTING_DEFAULTS
 def GetSetting(key,default=None):
-  # repeated calls to load_settings return same object without further disk reads
-  debug("GetSetting: " + str(key) + " (default: " + str(default) + ")")
-  settings = sublime.load_settings('Corona Editor.sublime-settings')
-  debug("GetSetting: value from CE settings: " + str(settings.get(key, default)))
-  # If we don't have a value for this preference in the Corona Editor settings, look in the view for a value
-  # (this happens if the preference is set in the main Sublime Text preference file instead of the Corona Editor file)
-  if not settings.get(key, default) and sublime and sublime.active_window() and sublime.active_window().active_view():
-    debug("GetSetting: getting value from view: " + str(sublime.active_window().active_view()))
-    settings = sublime.active_window().active_view().settings()
-
-  value = settings.get(key, default)
-
-  if not value:
+  if key in SETTING_DEFAULTS:
+    value = getattr(Settings, key)
+    return default if value is None else value
+
+  # The view's settings (the preferences and the project's settings) come first, as they do for Settings
+  value = None
+  if sublime.active_window() and sublime.active_window().active_view():
+    value = sublime.active_window().active_view().settings().get(key)
+  if value is None:
+    # repeated calls to load_settings return same object without further disk reads
+    value = sublime.load_settings('Corona Editor.sublime-settings').get(key, default)
+
+  if not value and Settings.corona_sdk_debug:
     debug("GetSetting: no value for preference '" + str(key) + "' found (using default '"+ str(default) + "')")
 
   return value
 
 
+# The arguments are only turned into strings if debugging is on (and then by the log's writer thread)
+# so it's cheap to call with values that are expensive to format
 def debug(*args):
-  global _corona_sdk_debug
-  if _corona_sdk_debug:
-    print("Corona Editor: ", '\t'.join(map(str, args)))
+  if _corona_log.isEnabledFor(_corona_log.DEBUG):
+    _corona_log.debug('\t'.join(["%s"] * len(args)), *args)
 
 
 InitializedEvent = threading.Event()
@@ -81,11 +164,8 @@ def Init():
   global PACKAGE_DIR
   global PACKAGE_USER_DIR
   global ST_PACKAGE_PATH
-  global _corona_sdk_debug
 
-  # Always look for "corona_sdk_debug" in 'Corona Editor.sublime-settings'
-  settings = sublime.load_settings('Corona Editor.sublime-settings')
-  _corona_sdk_debug = settings.get("corona_sdk_debug", False)
+  Settings.load()
 
   print("Corona Editor: Init")
   debug("Python: " + str(sys.version))
@@ -107,6 +187,7 @@ def Init():
 
   # This is the user dir on ST
   PACKAGE_USER_DIR = os.path.join(sublime.packages_path(), 'User', PACKAGE_NAME)
+  _corona_log.setLogFile(os.path.join(PACKAGE_USER_DIR, "debug.log"))
   debug("PACKAGE_USER_DIR: " + PACKAGE_USER_DIR)
 
   # This is the faux path used by various Sublime Text functions ("Packages/CoronaSDK/")
@@ -136,12 +217,12 @@ def GetSimulatorCmd(mainlua=None, debug=False):
 
   simulator_path = ""
   simulator_flags = []
-  simulator_version = GetSetting("corona_sdk_version", None)
+  simulator_version = Settings.corona_sdk_version
 
   if mainlua is not None:
     simulator_path = GetSimulatorPathFromBuildSettings(mainlua)
     if simulator_path is None:
-      simulator_path = GetSetting("corona_sdk_simulator_path", None)
+      simulator_path = Settings.corona_sdk_simulator_path
 
   if platform == "osx":
     if simulator_path is None:
@@ -151,7 +232,7 @@ def GetSimulatorCmd(mainlua=None, debug=False):
     if simulator_path.endswith(".app"):
       simulator_path += "/Contents/MacOS/Corona Simulator"
     simulator_flags = ["-singleton", "1"]
-    if not GetSetting("corona_sdk_simulator_show_console", False):
+    if not Settings.corona_sdk_simulator_show_console:
       simulator_flags += ["-no-console", "1"]
     if debug:
       simulator_flags.append("-debug")
@@ -170,7 +251,7 @@ def GetSimulatorCmd(mainlua=None, debug=False):
         if not os.path.isfile(simulator_path):
           simulator_path = "C:\\Program Files\\Corona Labs\\Corona SDK\\Corona Simulator.exe" # old location
     simulator_flags = ["/singleton"]
-    if not GetSetting("corona_sdk_simulator_show_console", False):
+    if not Settings.corona_sdk_simulator_show_console:
       simulator_flags += ["/no-console"]
     if debug:
       simulator_flags.append("/debug")
@@ -238,18 +319,94 @@ def GetSimulatorPathFromBuildSettings(mainlua):
   return simulator_path
 
 
-# Given an existing file path or directory, find the likely "main.lua" for this project
-def ResolveMainLua(path):
-  # debug("ResolveMainLua: path: "+str(path))
-  path = os.path.abspath(path)
-  if not os.path.isdir(path):
-    path = os.path.dirname(path)
+# Directories we don't look in when searching for a project's main.lua
+IGNORED_DIRS = frozenset([".git", ".svn", ".hg", "build", "node_modules"])
+
+# How many levels below a directory we'll look for a main.lua
+MAIN_LUA_SEARCH_DEPTH = 8
+
+
+# Finds the main.lua for a project and remembers the answer for every directory it looked at
+# so that repeated lookups don't have to touch the filesystem again.  Anything that creates or
+# deletes a main.lua needs to call invalidate()
+class ProjectRootResolver(object):
+
+  def __init__(self):
+    self._above = {}  # directory -> main.lua in it or one of its parents (or None)
+    self._below = {}  # directory -> directory under it that contains a main.lua (or None)
+    self._lock = threading.Lock()
+
+  def invalidate(self):
+    with self._lock:
+      self._above.clear()
+      self._below.clear()
+
+  # Called when we hear about a main.lua we might not know about (e.g. it's just been saved)
+  def noteMainLua(self, mainlua):
+    if self._above.get(os.path.dirname(mainlua)) != mainlua:
+      self.invalidate()
+
+  # Look in the directory of 'path' (or 'path' itself if it's a directory) and then its parents
+  def mainLuaAbove(self, path):
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+      path = os.path.dirname(path)
+
+    visited = []
+    mainlua = None
+    directory = path
+    while True:
+      if directory in self._above:
+        mainlua = self._above[directory]
+        if mainlua is not None and not os.path.isfile(mainlua):
+          # it's been deleted behind our back
+          self.invalidate()
+          return self.mainLuaAbove(path)
+        break
+      parent = os.path.dirname(directory)
+      if parent == directory:
+        break  # we never use a main.lua at the root of the filesystem
+      visited.append(directory)
+      if os.path.isfile(os.path.join(directory, "main.lua")):
+        mainlua = os.path.join(directory, "main.lua")
+        break
+      directory = parent
+
+    with self._lock:
+      for d in visited:
+        self._above[d] = mainlua
 
-  mainlua = os.path.join(path, "main.lua")
-  if mainlua == "/main.lua" or mainlua == "\\main.lua":
-    return None
-  elif os.path.isfile(mainlua):
     return mainlua
-  else:
-    return ResolveMainLua(os.path.join(path, ".."))
 
+  # Look in 'directory' and the directories under it (not too deeply and skipping the likes of
+  # ".git") and return the first directory found containing a main.lua
+  def mainLuaBelow(self, directory):
+    if directory in self._below:
+      found = self._below[directory]
+      if found is None or os.path.isfile(os.path.join(found, "main.lua")):
+        return found
+
+    found = None
+    base_depth = directory.rstrip(os.sep).count(os.sep)
+    for root, dirs, files in os.walk(directory):
+      if "main.lua" in files:
+        found = root
+        break
+      if root.count(os.sep) - base_depth >= MAIN_LUA_SEARCH_DEPTH:
+        dirs[:] = []
+      else:
+        dirs[:] = [d for d in dirs if d not in IGNORED_DIRS and not d.startswith(".")]
+
+    with self._lock:
+      self._below[directory] = found
+
+    return found
+
+
+ProjectRoots = ProjectRootResolver()
+
+
+# Given an existing file path or directory, find the likely "main.lua" for this project
+def ResolveMainLua(path):
+  # debug("ResolveMainLua: path: "+str(path))
+  return ProjectRoots.mainLuaAbove(path)
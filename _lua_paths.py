@@ -1,8 +1,22 @@
 import os
 import re
+import fnmatch
+import time
+import threading
+
+try:
+  from . import _corona_utils  # P3
+except:
+  import _corona_utils  # P2
 
 _findBackslash = re.compile("/")  
 
+# How often (in seconds) a project's file index is checked for changes while it's being used
+INDEX_REFRESH_INTERVAL = 5
+
+_projectIndexes = {}
+_projectIndexesLock = threading.Lock()
+
 # http://rosettacode.org/wiki/Find_common_directory_path#Python
 def __commonprefix(*args, sep='/'):
   return os.path.commonprefix(*args).rpartition(sep)[0]
@@ -21,6 +35,15 @@ def __getProjectPaths(view):
   
   return paths   
 
+def __getProjectFolderSettings(view):
+  project_data=view.window().project_data()
+  settings={}
+  if project_data is not None and "folders" in project_data:
+    for f in project_data["folders"]:
+      if "path" in f:
+        settings[f["path"]]=f
+  return settings
+
 def __getOpenFiles(view):
   allViews=view.window().views()
   openFiles=[]
@@ -34,27 +57,265 @@ def __getViewPath(view):
   folders=view.window().folders()
   files=__getOpenFiles(view)
   searchpath=__commonprefix(folders+files)
-  for root, dirs, files in os.walk(searchpath):
-    for name in files:
-      if "main.lua"==name:
-        return root
+  return _corona_utils.ProjectRoots.mainLuaBelow(searchpath)
     
+def _mtime(path):
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+# Compile a list of glob patterns into a single regex (None if there are none)
+def _compilePatterns(patterns):
+  if not patterns:
+    return None
+  return re.compile("|".join("(?:" + fnmatch.translate(p) + ")" for p in patterns))
+
+# Decides what's left out of a project's file index: directories and files matching Sublime Text's
+# "folder_exclude_patterns" and "file_exclude_patterns" or the project's .gitignore.  Excluded
+# directories are pruned from the walk so nothing under them is ever visited.
+class ExcludeFilter(object):
+
+  def __init__(self, root, folder_patterns=(), file_patterns=()):
+    self.root = root
+    folder_names = list(folder_patterns)
+    file_names = list(file_patterns)
+    folder_paths = []
+    file_paths = []
+
+    # Simplified .gitignore rules: negation isn't supported, a trailing slash matches only
+    # directories and a pattern containing a slash is matched against the path relative to the
+    # root rather than just the name
+    for pattern in self.__readGitignore():
+      dirs_only = pattern.endswith("/")
+      pattern = pattern.rstrip("/")
+      if pattern.startswith("**/"):
+        pattern = pattern[3:]
+      if "/" in pattern:
+        pattern = pattern.lstrip("/")
+        folder_paths.append(pattern)
+        if not dirs_only:
+          file_paths.append(pattern)
+      else:
+        folder_names.append(pattern)
+        if not dirs_only:
+          file_names.append(pattern)
+
+    self._folderNames = _compilePatterns(folder_names)
+    self._fileNames = _compilePatterns(file_names)
+    self._folderPaths = _compilePatterns(folder_paths)
+    self._filePaths = _compilePatterns(file_paths)
+
+  def __readGitignore(self):
+    patterns = []
+    try:
+      with open(os.path.join(self.root, ".gitignore")) as fd:
+        for line in fd:
+          line = line.strip()
+          if line and not line.startswith("#") and not line.startswith("!"):
+            patterns.append(line)
+    except (IOError, OSError, UnicodeDecodeError):
+      pass
+    return patterns
+
+  def __relpath(self, directory, name):
+    return os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, "/")
+
+  def excludesFolder(self, directory, name):
+    if self._folderNames is not None and self._folderNames.match(name):
+      return True
+    return self._folderPaths is not None and self._folderPaths.match(self.__relpath(directory, name)) is not None
+
+  def excludesFile(self, directory, name):
+    if self._fileNames is not None and self._fileNames.match(name):
+      return True
+    return self._filePaths is not None and self._filePaths.match(self.__relpath(directory, name)) is not None
+
+# The files in a directory tree.  The index is built in the background the first time it's
+# used and after that only directories whose modification time has changed (which happens
+# when entries are added to, removed from or renamed in them) are reread.
+class ProjectFileIndex(object):
+
+  def __init__(self, root, followlinks=False, exclude=None):
+    self.root = root
+    self.followlinks = followlinks
+    self.exclude = exclude if exclude is not None else ExcludeFilter(root)
+    self.checked = None
+    self._dirs = {}  # directory path -> (mtime, [file names])
+    self._generation = 0  # changes whenever _dirs does
+    self._paths = {}  # (suffixes, Lua paths?) -> (generation, [(name, path)]), see paths()
+    self._lock = threading.Lock()
+    self._scanning = False
+
+  # Start a background scan if we haven't got one or haven't checked for changes recently
+  def update(self):
+    with self._lock:
+      if self._scanning or (self.checked is not None and time.time() - self.checked < INDEX_REFRESH_INTERVAL):
+        return
+      self._scanning = True
+    scanner = threading.Thread(target=self.__scan)
+    scanner.daemon = True
+    scanner.start()
+
+  def __scan(self):
+    try:
+      if self.checked is None:
+        self.build()
+      else:
+        self.refresh()
+    finally:
+      with self._lock:
+        self._scanning = False
+        self.checked = time.time()
+
+  def build(self):
+    dirs = self.__walk(self.root)
+    with self._lock:
+      self._dirs = dirs
+      self._generation += 1
+
+  def __walk(self, path):
+    dirs = {}
+    for root, dirnames, filenames in os.walk(path, followlinks=self.followlinks):
+      dirnames[:] = [d for d in dirnames if not self.exclude.excludesFolder(root, d)]
+      dirs[root] = (_mtime(root), [f for f in filenames if not self.exclude.excludesFile(root, f)])
+    return dirs
+
+  def refresh(self):
+    with self._lock:
+      known = dict(self._dirs)
+
+    for path, (mtime, filenames) in known.items():
+      if _mtime(path) == mtime:
+        continue
+
+      # Reread this directory and walk any subdirectories we haven't seen before
+      updates = {}
+      removed = [d for d in known if d.startswith(path + os.sep)]
+      try:
+        entries = os.listdir(path)
+      except OSError:
+        removed.append(path)
+      else:
+        updates[path] = (_mtime(path), [])
+        if ("main.lua" in entries) != ("main.lua" in filenames):
+          _corona_utils.ProjectRoots.invalidate()
+        for name in entries:
+          fullpath = os.path.join(path, name)
+          if not os.path.isdir(fullpath):
+            if not self.exclude.excludesFile(path, name):
+              updates[path][1].append(name)
+          elif self.exclude.excludesFolder(path, name):
+            continue
+          elif fullpath in known:
+            removed.remove(fullpath)
+            removed = [d for d in removed if not d.startswith(fullpath + os.sep)]
+          elif self.followlinks or not os.path.islink(fullpath):
+            updates.update(self.__walk(fullpath))
+
+      with self._lock:
+        for d in removed:
+          self._dirs.pop(d, None)
+        self._dirs.update(updates)
+        self._generation += 1
+
+  # Note a file we've heard about from the editor (e.g. it's been saved) without waiting for the
+  # next check of the directory
+  def add_file(self, path):
+    dirname, name = os.path.split(path)
+    if self.exclude.excludesFile(dirname, name):
+      return
+    with self._lock:
+      if dirname in self._dirs and name not in self._dirs[dirname][1]:
+        self._dirs[dirname][1].append(name)
+        self._generation += 1
+
+  # (directory path, [file names]) for every directory in the index
+  def items(self):
+    with self._lock:
+      return [(d, list(filenames)) for d, (mtime, filenames) in self._dirs.items()]
+
+  # (name, path relative to the root) for every file ending with one of 'suffixes' (see
+  # _suffixSet()), without the extension and with dots for slashes if 'luapaths' ("dir.module").
+  # The list is only made again after the index changes so don't modify it.
+  def paths(self, suffixes, luapaths):
+    key = (frozenset(suffixes), luapaths)
+    with self._lock:
+      generation = self._generation
+      cached = self._paths.get(key)
+      if cached is not None and cached[0] == generation:
+        return cached[1]
+      dirs = [(d, list(filenames)) for d, (mtime, filenames) in self._dirs.items()]
+
+    paths = []
+    for root, files in dirs:
+      for name in files:
+        if _hasSuffix(name, suffixes):
+          if luapaths:
+            name=os.path.splitext(name)[0]
+          relpath=os.path.relpath(os.path.join(root, name),start=self.root)
+          if luapaths:
+            relpath=_findBackslash.sub(".",relpath)
+          paths.append((name,relpath))
+
+    with self._lock:
+      self._paths[key] = (generation, paths)
+    return paths
+
+
+def getProjectIndex(root, followlinks=False, folder_patterns=(), file_patterns=()):
+  key = (root, followlinks, tuple(folder_patterns), tuple(file_patterns))
+  with _projectIndexesLock:
+    index = _projectIndexes.get(key)
+    if index is None:
+      index = ProjectFileIndex(root, followlinks, ExcludeFilter(root, folder_patterns, file_patterns))
+      _projectIndexes[key] = index
+  index.update()
+  return index
+
+# The extensions to complete as a set of lowercase suffixes (".png", ".lua", ...)
+def _suffixSet(extensions):
+  return set(ext.lower() if ext.startswith(".") else "." + ext.lower() for ext in extensions)
+
+# Does the file name end with one of the suffixes (this also handles suffixes like ".tar.gz")
+def _hasSuffix(name, suffixes):
+  name = name.lower()
+  i = name.find(".")
+  while i != -1:
+    if name[i:] in suffixes:
+      return True
+    i = name.find(".", i + 1)
+  return False
+
+# Called when the editor loads or saves a file
+def fileChanged(path):
+  if path is None:
+    return
+  if os.path.basename(path) == "main.lua":
+    _corona_utils.ProjectRoots.noteMainLua(path)
+  with _projectIndexesLock:
+    indexes = list(_projectIndexes.values())
+  for index in indexes:
+    if path.startswith(index.root + os.sep):
+      index.add_file(path)
+
 def getFilesAndPaths(view,extensions=[".lua"],followlinks=False,converttoluapaths=True): 
   luaPaths=[]
   paths=__getProjectPaths(view)
   viewPath=__getViewPath(view)
   if viewPath is not None:
     paths.append(viewPath)
+
+  suffixes=_suffixSet(extensions)
+  folderSettings=__getProjectFolderSettings(view)
+  folderExcludes=view.settings().get("folder_exclude_patterns") or []
+  fileExcludes=view.settings().get("file_exclude_patterns") or []
     
   for path in paths:
-    for root, dirs, files in os.walk(path,followlinks=followlinks):
-      for name in files:
-        if any(ext in name.lower() for ext in extensions):
-          if converttoluapaths:
-            name=os.path.splitext(name)[0]
-          relpath=os.path.relpath(os.path.join(root, name),start=path)
-          if converttoluapaths:
-            relpath=_findBackslash.sub(".",relpath)
-          luaPaths.append((name,relpath))
+    folder=folderSettings.get(path, {})
+    index=getProjectIndex(path, followlinks,
+                          folderExcludes + folder.get("folder_exclude_patterns", []),
+                          fileExcludes + folder.get("file_exclude_patterns", []))
+    luaPaths.extend(index.paths(suffixes, converttoluapaths))
             
-    return luaPaths
\ No newline at end of file
+  return luaPaths
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+#
+# Sublime Text plugin to support Solar2D Editor
+#
+# Copyright (c) 2020 Solar2D.
+#
+# MIT License - see https://raw.github.com/coronalabs/CoronaSDK-SublimeText/master/LICENSE
+#
+# bench_completions.py - replay keystrokes against the completion code outside Sublime Text
+#
+# The "sublime" and "sublime_plugin" modules are replaced by just enough of a stand in to load
+# completions.py and a fake view is typed into one keystroke at a time, asking for completions after
+# each one the way ST does.  There are two sets of keystroke sequences: Solar2D API calls which are
+# replayed against each docset and require() / asset paths which are replayed against synthetic
+# project trees (1k, 10k and 100k files by default).  For each sequence we report the time taken
+# per keystroke and after each docset or tree the per stage timings kept by completions.py.
+#
+# Usage: bench_completions.py [--docsets public legacy daily] [--sizes 1000 10000 100000] [--repeat N]
+#
+
+import os
+import re
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import tempfile
+
+PACKAGE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Keystroke sequences, each is the text of the line before we start typing and what's typed ("\b"
+# is a backspace)
+API_SEQUENCES = [
+  ("local title = ", "display.newText"),
+  ("", "transition.to"),
+  ("", "physics.addBody"),
+  ("", "nativ\b\b\bative.showAlert"),
+  ("local channel = ", "audio.loadS\b\bplay"),
+  ("", "timer.performWithDelay"),
+  ("local sheet = ", "graphics.newImageSheet"),
+  ("", "dsplnwrct"),
+]
+
+PATH_SEQUENCES = [
+  ("local scene = require(\"", "pkg1.mod1.scene_1"),
+  ("local lib = require(\"", "pkg9.mod\b\b\bmod1.lib_"),
+  ("local image = display.newImage(\"", "sprite_12"),
+  ("local sound = audio.loadSound(\"", "pkg3/mod1/sound"),
+]
+
+# Files per directory in the synthetic project trees and the kinds of file in them
+FILES_PER_DIR = 50
+FILE_KINDS = ["scene_{0}.lua", "lib_{0}.lua", "sprite_{0}.png", "sound_{0}.wav", "notes_{0}.txt"]
+
+
+#
+# Stand ins for the Sublime Text API
+#
+
+CLASS_LINE_START = 1
+CLASS_LINE_END = 2
+
+
+class Settings(object):
+
+  def __init__(self, values=None):
+    self.values = dict(values or {})
+    self.callbacks = {}
+
+  def get(self, key, default=None):
+    return self.values.get(key, default)
+
+  def set(self, key, value):
+    self.values[key] = value
+    for callback in list(self.callbacks.values()):
+      callback()
+
+  def has(self, key):
+    return key in self.values
+
+  def add_on_change(self, key, callback):
+    self.callbacks[key] = callback
+
+  def clear_on_change(self, key):
+    self.callbacks.pop(key, None)
+
+
+class Region(object):
+
+  def __init__(self, a, b=None):
+    self.a = a
+    self.b = a if b is None else b
+
+  def begin(self):
+    return min(self.a, self.b)
+
+  def end(self):
+    return max(self.a, self.b)
+
+
+class FakeWindow(object):
+
+  def __init__(self, folders=()):
+    self._folders = list(folders)
+    self._views = []
+
+  def folders(self):
+    return self._folders
+
+  def project_data(self):
+    return None
+
+  def views(self):
+    return self._views
+
+
+class FakeView(object):
+
+  _next_id = 0
+  _findWords = re.compile(r"[\w.]+")
+
+  def __init__(self, text, window, file_name=None):
+    FakeView._next_id += 1
+    self._id = FakeView._next_id
+    self._window = window
+    self._window._views.append(self)
+    self._file_name = file_name
+    self._settings = Settings()
+    self.text = text
+    self.pos = len(text)
+
+  def id(self):
+    return self._id
+
+  # Editing
+  def type(self, key):
+    if key == "\b":
+      self.text = self.text[:self.pos - 1] + self.text[self.pos:]
+      self.pos -= 1
+    else:
+      self.text = self.text[:self.pos] + key + self.text[self.pos:]
+      self.pos += 1
+
+  def sel(self):
+    return [Region(self.pos)]
+
+  def size(self):
+    return len(self.text)
+
+  def substr(self, x):
+    if isinstance(x, Region):
+      return self.text[x.begin():x.end()]
+    return self.text[x] if x < len(self.text) else "\x00"
+
+  def classify(self, point):
+    flags = 0
+    if point == 0 or self.text[point - 1] == "\n":
+      flags |= CLASS_LINE_START
+    if point >= len(self.text) or self.text[point] == "\n":
+      flags |= CLASS_LINE_END
+    return flags
+
+  def rowcol(self, point):
+    return (self.text.count("\n", 0, point), point - (self.text.rfind("\n", 0, point) + 1))
+
+  def text_point(self, row, col):
+    point = 0
+    for i in range(row):
+      point = self.text.index("\n", point) + 1
+    return point + col
+
+  # Like ST, the words in the document starting with the prefix
+  def extract_completions(self, prefix):
+    return sorted(set(w for w in self._findWords.findall(self.text) if w.startswith(prefix) and w != prefix))
+
+  def match_selector(self, point, selector):
+    return True
+
+  def file_name(self):
+    return self._file_name
+
+  def window(self):
+    return self._window
+
+  def settings(self):
+    return self._settings
+
+  def is_valid(self):
+    return True
+
+
+def stub_sublime():
+  settings = Settings(load_default_settings())
+
+  sublime = types.ModuleType("sublime")
+  sublime.CLASS_LINE_START = CLASS_LINE_START
+  sublime.CLASS_LINE_END = CLASS_LINE_END
+  sublime.Region = Region
+  sublime.version = lambda: "4126"
+  sublime.platform = lambda: sys.platform
+  sublime.arch = lambda: "x64"
+  sublime.packages_path = lambda: os.path.dirname(PACKAGE_DIR)
+  sublime.load_settings = lambda name: settings
+  sublime.save_settings = lambda name: None
+  sublime.active_window = lambda: None
+  sublime.windows = lambda: []
+  sublime.set_timeout = lambda callback, delay=0: callback()
+  sublime.status_message = lambda msg: None
+  # "Packages/<package name>/<file>" (the package name depends on where the package is installed)
+  sublime.load_binary_resource = lambda name: open(os.path.join(PACKAGE_DIR, name.split("/", 2)[2]), "rb").read()
+  sublime.load_resource = lambda name: sublime.load_binary_resource(name).decode("utf-8")
+
+  sublime_plugin = types.ModuleType("sublime_plugin")
+  for name in ["EventListener", "TextCommand", "WindowCommand", "ApplicationCommand"]:
+    setattr(sublime_plugin, name, type(name, (object,), {}))
+
+  sys.modules["sublime"] = sublime
+  sys.modules["sublime_plugin"] = sublime_plugin
+  return settings
+
+
+# The package's default settings (without the comments)
+def load_default_settings():
+  with open(os.path.join(PACKAGE_DIR, "Corona Editor.sublime-settings")) as fd:
+    return json.loads("".join(line for line in fd if not line.strip().startswith("//")))
+
+
+#
+# Benchmark
+#
+
+# A Lua document to type into, its words are what extract_completions() returns
+def sample_document(lines=500):
+  body = []
+  for i in range(lines):
+    body.append("local value{0} = display.contentCenterX + {0} -- item{1}".format(i, i % 37))
+  return "\n".join(body) + "\n\n"
+
+
+def make_tree(root, nfiles):
+  ndirs = (nfiles + FILES_PER_DIR - 1) // FILES_PER_DIR
+  with open(os.path.join(root, "main.lua"), "w") as fd:
+    fd.write("-- main.lua\n")
+  for d in range(ndirs):
+    directory = os.path.join(root, "pkg{0}".format(d % 10), "mod{0}".format(d // 10))
+    os.makedirs(directory)
+    for f in range(min(FILES_PER_DIR, nfiles - d * FILES_PER_DIR)):
+      open(os.path.join(directory, FILE_KINDS[f % len(FILE_KINDS)].format(f)), "w").close()
+
+
+def summarize(samples):
+  samples = sorted(samples)
+  return (sum(samples) / len(samples), samples[len(samples) // 2], samples[int(len(samples) * 0.9)], samples[-1])
+
+
+def replay(corona, view, keys):
+  samples = []
+  results = 0
+  for key in keys:
+    view.type(key)
+    start = time.time()
+    comps = corona.find_completions(view, "")
+    samples.append((time.time() - start) * 1000)
+    results = len(comps)
+  return samples, results
+
+
+# Returns the sequences which gave no completions
+def run_sequences(completions, corona, window, sequences, repeat, label):
+  empty = []
+  print("{0:<48} {1:>5} {2:>8} {3:>8} {4:>8} {5:>8} {6:>8}".format(label, "keys", "mean ms", "p50 ms", "p90 ms", "max ms", "results"))
+  document = sample_document()
+  for line, keys in sequences:
+    samples = []
+    for i in range(repeat):
+      view = FakeView(document + line, window, os.path.join(window.folders()[0], "main.lua") if window.folders() else None)
+      keystrokes, results = replay(corona, view, keys)
+      samples.extend(keystrokes)
+      corona.forget_view(view)
+    typed = repr(line + keys.replace("\b", "<"))
+    print("{0:<48} {1:>5} {2:>8.2f} {3:>8.2f} {4:>8.2f} {5:>8.2f} {6:>8}".format(typed[:48], len(keys), *(summarize(samples) + (results,))))
+    if results == 0:
+      empty.append(typed)
+  return empty
+
+
+def print_timings(completions):
+  print("")
+  for line in completions.CoronaCompletionTimings.report():
+    print("  " + line)
+  print("")
+  completions.CoronaCompletionTimings.reset()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Replay keystrokes against the Solar2D Editor completion code")
+  parser.add_argument("--docsets", nargs="*", default=["public", "legacy", "daily"])
+  parser.add_argument("--sizes", nargs="*", type=int, default=[1000, 10000, 100000])
+  parser.add_argument("--repeat", type=int, default=5, help="times to replay each sequence")
+  args = parser.parse_args()
+
+  settings = stub_sublime()
+  sys.path.insert(0, PACKAGE_DIR)
+  import _corona_utils
+  _corona_utils.Init()
+  import _lua_paths
+  import completions
+
+  corona = completions.CoronaLabs()
+
+  for docset in args.docsets:
+    settings.set("corona_sdk_use_docset", docset)
+    completions.CoronaCompletionTimings.reset()
+    run_sequences(completions, corona, FakeWindow(), API_SEQUENCES, args.repeat, "docset " + docset)
+    print_timings(completions)
+
+  settings.set("corona_sdk_use_docset", "public")
+  failed = []
+  for size in args.sizes:
+    # The project root is looked for below the parent of the window's folders so the tree needs a
+    # parent of its own (or any main.lua elsewhere in the temp directory could be used instead)
+    parent = tempfile.mkdtemp(prefix="bench_completions_")
+    root = os.path.join(parent, "project")
+    os.mkdir(root)
+    try:
+      start = time.time()
+      make_tree(root, size)
+      created = time.time() - start
+
+      # Wait for the file index to be built in the background (as happens after the first path completion)
+      start = time.time()
+      index = _lua_paths.getProjectIndex(root)
+      while index.checked is None:
+        time.sleep(0.001)
+      built = time.time() - start
+
+      completions.CoronaCompletionTimings.reset()
+      print("tree of {0} files (created in {1:.1f}s, indexed in {2:.1f}ms)".format(size, created, built * 1000))
+      empty = run_sequences(completions, corona, FakeWindow([root]), PATH_SEQUENCES, args.repeat, "{0} files".format(size))
+      failed.extend("{0} ({1} files)".format(typed, size) for typed in empty)
+      print_timings(completions)
+    finally:
+      shutil.rmtree(parent)
+
+  # Path completion that finds nothing isn't measuring anything
+  if failed:
+    print("FAILED: no completions for " + ", ".join(failed))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# Sublime Text plugin to support Solar2D Editor
+#
+# Copyright (c) 2020 Solar2D.
+#
+# MIT License - see https://raw.github.com/coronalabs/CoronaSDK-SublimeText/master/LICENSE
+#
+# bench_create_completions.py - compare gen_completions/create-completions with create-completions.sh
+#
+# Both generators are run on a copy of gen_completions (so the package's completions files aren't
+# touched) against a docs directory whose name ends in "-public" (the shell version only does that
+# docset).  The Python version is timed with an empty cache, again with everything cached and after
+# one page has changed.  The raw completions each generator makes are compared.  If you don't have a
+# docs directory, "--synthetic N" makes one with N API pages from the current raw completions.
+#
+# Usage: bench_create_completions.py [--synthetic N] [--jobs N] [<docs-dir>-public]
+#
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+PACKAGE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+GEN_DIR = os.path.join(PACKAGE_DIR, "gen_completions")
+
+GEN_FILES = ["create-completions", "create-completions.sh", "mk_sublime_completions.py", "mk_completions_index.py",
+             "invalid-completions-list", "additional-completions-list"]
+
+
+# A docs directory laid out like the Solar2D docs (markdown/api/<library or type>/<name>/<item>.markdown)
+# with 'npages' pages made from the syntax strings in raw-api-definitions-public
+def make_docs(root, npages):
+  with open(os.path.join(GEN_DIR, "raw-api-definitions-public")) as fd:
+    syntax = [line.rstrip("\n").partition("\t") for line in fd if "\t" in line]
+
+  for i in range(npages):
+    comp, tab, library = syntax[i % len(syntax)]
+    library = re.sub(r"\W", "", library) or "misc"
+    name = re.sub(r"\W", "", comp.replace(":", ".").partition("(")[0].rpartition(".")[2]) or "item"
+    group = "type" if library[:1].isupper() else "library"
+    directory = os.path.join(root, "markdown", "api", group, library + ("" if i < len(syntax) else str(i // len(syntax))))
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+      with open(os.path.join(directory, "index.markdown"), "w") as fd:
+        fd.write("# " + library + "\n")
+    with open(os.path.join(directory, name + str(i) + ".markdown"), "w") as fd:
+      fd.write("# {0}\n\n> __Type__ [Function][api.type.Function]\n\n## Overview\n\nSee `{0}`.\n\n".format(comp))
+      fd.write("## Syntax\n\n\t{0}\n\n".format(comp.replace(name, name + str(i), 1)))
+      if i % 7 == 0:
+        fd.write("## Properties\n\n`{0}.extra{1}` <!-- completion -->\n\n".format(library, i))
+      fd.write("## Example\n\n``````lua\n\tlocal {0} = {1}\n``````\n".format(name + str(i), comp))
+
+
+def run(label, cmd, cwd):
+  start = time.time()
+  with open(os.devnull, "w") as devnull:
+    subprocess.check_call(cmd, cwd=cwd, stdout=devnull)
+  elapsed = time.time() - start
+  print("{0:<40} {1:>8.2f}s".format(label, elapsed))
+  return elapsed
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Compare create-completions with create-completions.sh")
+  parser.add_argument("docs", nargs="?", help="docs directory (its name must end in -public)")
+  parser.add_argument("--synthetic", type=int, default=2000, help="pages in the docs made if no docs directory is given")
+  parser.add_argument("--jobs", type=int, default=None, help="processes for create-completions")
+  args = parser.parse_args()
+
+  work = tempfile.mkdtemp(prefix="bench_create_completions_")
+  try:
+    docs = args.docs
+    if docs is None:
+      docs = os.path.join(work, "docs-public")
+      make_docs(docs, args.synthetic)
+    docs = os.path.abspath(docs)
+
+    gen = os.path.join(work, "package", "gen_completions")
+    os.makedirs(gen)
+    shutil.copy(os.path.join(PACKAGE_DIR, "_completion_index.py"), os.path.join(work, "package"))
+    for name in GEN_FILES:
+      shutil.copy(os.path.join(GEN_DIR, name), gen)
+
+    jobs = [] if args.jobs is None else ["--jobs", str(args.jobs)]
+    python = [sys.executable, "create-completions"] + jobs
+    raw = os.path.join(gen, "raw-api-definitions-public")
+
+    shell = run("create-completions.sh", ["bash", "create-completions.sh", docs], gen)
+    shutil.move(raw, raw + ".sh")
+    cold = run("create-completions (empty cache)", python + ["--no-cache", docs], gen)
+    warm = run("create-completions (cached)", python + [docs], gen)
+
+    # Change one page
+    for root, dirnames, filenames in os.walk(os.path.join(docs, "markdown", "api")):
+      pages = sorted(f for f in filenames if f != "index.markdown")
+      if pages:
+        with open(os.path.join(root, pages[0]), "a") as fd:
+          fd.write("\n")
+        break
+    run("create-completions (one page changed)", python + [docs], gen)
+
+    print("")
+    print("speed up: {0:.1f}x (empty cache), {1:.1f}x (cached)".format(shell / cold, shell / warm))
+    with open(raw + ".sh", "rb") as fd:
+      shellComps = fd.read()
+    with open(raw, "rb") as fd:
+      pythonComps = fd.read()
+    if shellComps == pythonComps:
+      print("raw completions are the same ({0} lines)".format(pythonComps.count(b"\n")))
+    else:
+      print("raw completions differ, see 'diff {0}.sh {0}'".format(raw))
+      work = None  # keep them to look at
+  finally:
+    if work is not None:
+      shutil.rmtree(work)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Sublime Text plugin to support Solar2D Editor
+#
+# Copyright (c) 2020 Solar2D.
+#
+# MIT License - see https://raw.github.com/coronalabs/CoronaSDK-SublimeText/master/LICENSE
+#
+# bench_docsets.py - report the load time and memory use of each completions docset
+#
+# Each docset is loaded in a fresh Python process (the same way the plugin loads it, parsing the
+# API file and building the completion index) so the resident memory figures don't interfere.  The
+# time to load the prebuilt index made by gen_completions/mk_completions_index.py is shown too
+#
+
+import os
+import sys
+import json
+import time
+import subprocess
+import tracemalloc
+
+PACKAGE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+DOCSETS = ["public", "legacy", "daily"]
+LOADS = 10
+
+sys.path.insert(0, PACKAGE_DIR)
+import _completion_index
+
+
+# Current resident set size in KB (or the peak if we can't get the current value)
+def resident_memory():
+  try:
+    with open("/proc/self/statm") as fd:
+      return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+  except (IOError, OSError):
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def load(path):
+  with open(path) as fd:
+    text = fd.read()
+  return _completion_index.CompletionIndex(json.loads(text)['entries'])
+
+
+# Load the prebuilt index the way the plugin does (None if there isn't one for this docset)
+def load_prebuilt(path):
+  if not os.path.isfile(path + _completion_index.INDEX_SUFFIX):
+    return None
+  with open(path, "rb") as fd:
+    source = fd.read()
+  with open(path + _completion_index.INDEX_SUFFIX, "rb") as fd:
+    return _completion_index.load_index(fd.read(), source)
+
+
+def median_time(func, path):
+  times = []
+  for i in range(LOADS):
+    start = time.time()
+    func(path)
+    times.append(time.time() - start)
+  times.sort()
+  return times[len(times) // 2]
+
+
+# Runs in the child process, prints one line of JSON with the results
+def measure(docset):
+  path = os.path.join(PACKAGE_DIR, "corona.api-" + docset)
+
+  rss_before = resident_memory()
+  start = time.time()
+  index = load(path)
+  first_load = time.time() - start
+  rss_after = resident_memory()
+
+  median_load = median_time(load, path)
+  median_prebuilt = median_time(load_prebuilt, path) if load_prebuilt(path) is not None else None
+
+  tracemalloc.start()
+  index = load(path)
+  allocated = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+
+  print(json.dumps({
+    "docset": docset,
+    "completions": len(index),
+    "file_kb": os.path.getsize(path) // 1024,
+    "first_load_ms": first_load * 1000,
+    "median_load_ms": median_load * 1000,
+    "prebuilt_load_ms": median_prebuilt * 1000 if median_prebuilt is not None else float("nan"),
+    "rss_kb": rss_after - rss_before,
+    "index_kb": allocated // 1024,
+  }))
+
+
+def main():
+  print("{0:<8} {1:>11} {2:>8} {3:>14} {4:>15} {5:>17} {6:>10} {7:>10}".format(
+        "docset", "completions", "file KB", "first load ms", "median load ms", "prebuilt load ms", "RSS KB", "index KB"))
+  for docset in DOCSETS:
+    output = subprocess.check_output([sys.executable, __file__, "--measure", docset])
+    r = json.loads(output.decode("utf-8"))
+    print("{docset:<8} {completions:>11} {file_kb:>8} {first_load_ms:>14.1f} {median_load_ms:>15.1f} {prebuilt_load_ms:>17.1f} {rss_kb:>10} {index_kb:>10}".format(**r))
+
+
+if __name__ == "__main__":
+  if len(sys.argv) == 3 and sys.argv[1] == "--measure":
+    measure(sys.argv[2])
+  else:
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Sublime Text plugin to support Solar2D Editor
+#
+# Copyright (c) 2020 Solar2D.
+#
+# MIT License - see https://raw.github.com/coronalabs/CoronaSDK-SublimeText/master/LICENSE
+#
+# check_fuzzy_golden.py - check completions.FuzzyMatcher against the regex scorer it replaced
+#
+# The patterns (prefixes of the candidates, patterns with characters skipped or swapped and ones
+# made of random characters) are scored against the triggers of each docset, using
+# FuzzyMatcher.score_many() like the plugin does, and against a corpus of file names and Lua paths,
+# using FuzzyMatcher.score() like path completion does.  Every pattern and candidate must
+# be accepted or rejected (a score above the threshold of 5) by both scorers.  The exit status is 1
+# if any aren't.
+#
+# Usage: check_fuzzy_golden.py [--patterns N] [--paths N] [--seed N]
+#
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+
+from bench_completions import stub_sublime, FILES_PER_DIR, FILE_KINDS
+
+PACKAGE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+DOCSETS = ["public", "legacy", "daily"]
+THRESHOLD = 5
+
+# Disagreements shown before giving up on a corpus
+MAX_REPORTED = 10
+
+
+# The scorer FuzzyMatcher used to be
+class RegexFuzzyMatcher():
+
+  def __init__(self):
+    self.prefix_match_tweak = 20
+    self.regex1 = ''
+    self.regex2 = ''
+
+  def setPattern(self, pattern):
+    self.regex1 = re.compile('.*?'.join(map(re.escape, list(pattern))))  # look for characters in pattern in order
+    self.regex2 = re.compile('\\b'+re.escape(pattern))  # look for exact prefixes matching pattern
+
+  def score(self, string):
+    match = self.regex1.search(string)
+    tweak = self.regex2.search(string)
+    if match is None:
+      return 0
+    else:
+      return (100.0 / ((1 + match.start()) * (match.end() - match.start() + 1))) + (self.prefix_match_tweak if tweak is not None else 0)
+
+
+# File names and Lua paths like those in a project tree of 'nfiles' files (see bench_completions.make_tree)
+def path_corpus(nfiles):
+  paths = []
+  for n in range(nfiles):
+    d, f = divmod(n, FILES_PER_DIR)
+    name = FILE_KINDS[f % len(FILE_KINDS)].format(f)
+    directory = "pkg{0}/mod{1}".format(d % 10, d // 10)
+    paths.append(name)
+    paths.append(directory.replace("/", ".") + "." + name.rpartition(".")[0] if name.endswith(".lua") else directory + "/" + name)
+  return paths
+
+
+def make_patterns(strings, count, rng):
+  patterns = set(["", "a", "_", ".", "(", "zzz"])
+  alphabet = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._:/("
+  while len(patterns) < count:
+    s = rng.choice(strings).partition("\t")[0]
+    kind = rng.randrange(4)
+    if kind == 0:
+      pattern = s[:rng.randint(1, min(len(s), 12))]
+    elif kind == 1:
+      pattern = "".join(ch for ch in s if rng.random() < 0.4)[:10]
+    elif kind == 2:
+      chars = list(s[:rng.randint(2, min(len(s), 8) if len(s) > 2 else 2)])
+      rng.shuffle(chars)
+      pattern = "".join(chars)
+    else:
+      pattern = "".join(rng.choice(alphabet) for i in range(rng.randint(1, 4)))
+    if pattern:
+      patterns.add(pattern)
+  return sorted(patterns)
+
+
+# Compare the scorers over a corpus, returns the number of disagreements
+def check(label, matcher, regex, patterns, strings, score):
+  disagreements = 0
+  comparisons = 0
+  newTime = oldTime = 0.0
+  for pattern in patterns:
+    matcher.setPattern(pattern)
+    regex.setPattern(pattern)
+    start = time.time()
+    new = score(matcher, strings)
+    newTime += time.time() - start
+    start = time.time()
+    old = [regex.score(s) for s in strings]
+    oldTime += time.time() - start
+    comparisons += len(strings)
+    for s, n, o in zip(strings, new, old):
+      if (n > THRESHOLD) != (o > THRESHOLD):
+        disagreements += 1
+        if disagreements <= MAX_REPORTED:
+          print("  {0}: pattern {1!r} string {2!r}: score {3:.2f} (regex {4:.2f})".format(label, pattern, s, n, o))
+  print("{0:<24} {1:>9} comparisons {2:>6} disagreements {3:>8.1f}ms ({4:.1f}ms regex)".format(
+    label, comparisons, disagreements, newTime * 1000, oldTime * 1000))
+  return disagreements
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Check the fuzzy completion scorer against the regex scorer")
+  parser.add_argument("--patterns", type=int, default=300, help="patterns for each corpus")
+  parser.add_argument("--paths", type=int, default=20000, help="files in the path corpus")
+  parser.add_argument("--seed", type=int, default=1)
+  args = parser.parse_args()
+
+  stub_sublime()
+  sys.path.insert(0, PACKAGE_DIR)
+  import _completion_index
+  import completions
+
+  rng = random.Random(args.seed)
+  matcher = completions.FuzzyMatcher()
+  regex = RegexFuzzyMatcher()
+  disagreements = 0
+
+  for docset in DOCSETS:
+    with open(os.path.join(PACKAGE_DIR, "corona.api-" + docset), "rb") as fd:
+      index = _completion_index.CompletionIndex(json.loads(fd.read().decode("utf-8"))['entries'])
+    patterns = make_patterns(index.triggers, args.patterns, rng)
+    disagreements += check("docset " + docset, matcher, regex, patterns, index.triggers,
+                           lambda m, strings: m.score_many(strings))
+
+  paths = path_corpus(args.paths)
+  patterns = make_patterns(paths, args.patterns // 10, rng)
+  disagreements += check("{0} paths".format(len(paths)), matcher, regex, patterns, paths,
+                         lambda m, strings: [m.score(s) for s in strings])
+
+  if disagreements:
+    print("FAILED: {0} disagreements with the regex scorer".format(disagreements))
+    sys.exit(1)
+  print("OK")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Sublime Text plugin to support Solar2D Editor
+#
+# Copyright (c) 2020 Solar2D.
+#
+# MIT License - see https://raw.github.com/coronalabs/CoronaSDK-SublimeText/master/LICENSE
+#
+# check_settings.py - check where _corona_utils.Settings and GetSetting() get each setting from
+#
+# The view's settings (which include the Sublime Text preferences and the project's settings) come
+# first, then the Corona Editor settings (the package's file and the user's), then SETTING_DEFAULTS.
+# The exit status is 1 if any of the checks fail.
+#
+# Usage: check_settings.py
+#
+
+import os
+import sys
+
+from bench_completions import stub_sublime, Settings
+
+PACKAGE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class FakeView(object):
+
+  def __init__(self, settings):
+    self._settings = settings
+
+  def settings(self):
+    return self._settings
+
+
+class FakeWindow(object):
+
+  def __init__(self, view):
+    self._view = view
+
+  def active_view(self):
+    return self._view
+
+
+def main():
+  packaged = stub_sublime()
+  sys.path.insert(0, PACKAGE_DIR)
+  import sublime
+  import _corona_utils
+
+  failures = []
+
+  def check(what, actual, expected):
+    print("{0:<64} {1!r:>8} {2}".format(what, actual, "ok" if actual == expected else "FAILED (expected {0!r})".format(expected)))
+    if actual != expected:
+      failures.append(what)
+
+  # What the package's settings file sets
+  check("packaged corona_sdk_auto_build", packaged.get("corona_sdk_auto_build"), False)
+  check("packaged corona_sdk_follow_symlinks", packaged.get("corona_sdk_follow_symlinks"), False)
+
+  view = Settings({"corona_sdk_auto_build": True, "corona_sdk_follow_symlinks": True, "corona_sdk_use_fuzzy_completion": False,
+                   "corona_sdk_extra": "view"})
+  sublime.active_window = lambda: FakeWindow(FakeView(view))
+  snapshot = _corona_utils.Settings
+  snapshot._viewSettings = view
+  packaged.values["corona_sdk_debugger_console_max_lines"] = 0
+  packaged.values["corona_sdk_extra"] = "package"
+  del packaged.values["corona_sdk_use_docset"]
+  snapshot.refresh()
+
+  check("true in the preferences beats a packaged false", snapshot.corona_sdk_auto_build, True)
+  check("true in the project beats a packaged false", snapshot.corona_sdk_follow_symlinks, True)
+  check("false in the preferences beats a packaged true", snapshot.corona_sdk_use_fuzzy_completion, False)
+  check("0 in the Corona Editor settings is kept", snapshot.corona_sdk_debugger_console_max_lines, 0)
+  check("packaged value when the view doesn't set it", snapshot.corona_sdk_complete_periods, True)
+  check("default when nothing sets it", snapshot.corona_sdk_use_docset, "public")
+  check("GetSetting() for a setting in SETTING_DEFAULTS", _corona_utils.GetSetting("corona_sdk_auto_build"), True)
+  check("GetSetting() for another setting set in the view", _corona_utils.GetSetting("corona_sdk_extra"), "view")
+  del view.values["corona_sdk_extra"]
+  check("GetSetting() for another setting set in the package", _corona_utils.GetSetting("corona_sdk_extra"), "package")
+  check("GetSetting() default", _corona_utils.GetSetting("corona_sdk_missing", "default"), "default")
+
+  if failures:
+    print("FAILED: " + ", ".join(failures))
+    sys.exit(1)
+  print("OK")
+
+
+if __name__ == "__main__":
+  main()
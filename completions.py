@@ -11,19 +11,37 @@ import sublime_plugin
 import os
 import re
 import json
+import bisect
+import threading
+import time
 
 try:
   from . import _corona_utils  # P3
+  from . import _completion_index  # P3
   from . import _lua_paths  # P3
   from . import _sublime_utils  # P3
 except:
   import _corona_utils  # P2
+  import _completion_index  # P2
   import _lua_paths  # P2
   import _sublime_utils  # P2
 
+try:
+  import queue  # P3
+  coronaQueue = queue
+except:
+  import Queue  # P2
+  coronaQueue = Queue
+
 # We expose the completions to the snippets code
 CoronaCompletions = None
 
+# Background thread that does the work for on_query_completions
+CoronaCompletionWorker = None
+
+# How long each stage of finding completions takes (see CompletionTimings)
+CoronaCompletionTimings = None
+
 #
 # Utility functions
 #
@@ -35,34 +53,264 @@ def is_string_instance(obj):
   except NameError:
     return isinstance(obj, str)
 
+
+# the equivalent of a regex '\w'
+def is_word_char(ch):
+  return ch.isalnum() or ch == '_'
+
+
 class FuzzyMatcher():
 
   def __init__(self):
     self.prefix_match_tweak = 20
-    self.regex1 = ''
-    self.regex2 = ''
+    self.pattern = ''
 
   def setPattern(self, pattern):
-    self.regex1 = re.compile('.*?'.join(map(re.escape, list(pattern))))  # look for characters in pattern in order
-    self.regex2 = re.compile('\\b'+re.escape(pattern))  # look for exact prefixes matching pattern
+    self.pattern = pattern
 
   def score(self, string):
-    match = self.regex1.search(string)
-    tweak = self.regex2.search(string)
-    if match is None:
+    return self.score_span(string, self.find_span(string))
+
+  # Score a batch of strings.  Matches of the pattern's characters (in order) score higher the
+  # earlier they start and the closer together they are, with a bonus if the pattern appears as
+  # is at the start of a word.
+  def score_many(self, strings):
+    return [self.score_span(string, self.find_span(string)) for string in strings]
+
+  def score_span(self, string, span):
+    if span is None:
       return 0
-    else:
-      return (100.0 / ((1 + match.start()) * (match.end() - match.start() + 1))) + (self.prefix_match_tweak if tweak is not None else 0)
+    start, end = span
+    score = 100.0 / ((1 + start) * (end - start + 1))
+    if self.is_word_prefix(string):
+      score += self.prefix_match_tweak
+    return score
+
+  # The earliest match of the pattern's characters in order begins at the first occurrence
+  # of the first character and continues with the next occurrence of each remaining one
+  def find_span(self, string):
+    if self.pattern == '':
+      return (0, 0)
+    start = end = string.find(self.pattern[0])
+    if start == -1:
+      return None
+    for ch in self.pattern[1:]:
+      end = string.find(ch, end + 1)
+      if end == -1:
+        return None
+    return (start, end + 1)
+
+  # Does the pattern occur in 'string' at a word boundary
+  def is_word_prefix(self, string):
+    i = string.find(self.pattern)
+    while i != -1:
+      before = i > 0 and is_word_char(string[i - 1])
+      after = i < len(string) and is_word_char(string[i])
+      if before != after:
+        return True
+      i = string.find(self.pattern, i + 1)
+    return False
+
+
+#
+# Completion timings
+#
+# A latency histogram for each stage of finding completions so we can tell where the time goes when
+# typing is slow.  The stages are:
+#   request - capturing the view state and settings (on the main thread)
+#   queue   - waiting for the completion worker
+#   load    - loading the docset (only slow when it changes)
+#   paths   - finding file paths for require() and asset completions
+#   extract - ST's extract_completions() (words in the document)
+#   match   - matching the docset against the completion target
+#   build   - making the list of completions returned to ST
+#   total   - everything except the request and queue stages
+class CompletionTimings():
+
+  STAGES = ("request", "queue", "load", "paths", "extract", "match", "build", "total")
+
+  # Upper bounds (in ms) of the histogram buckets, the last bucket is everything slower
+  BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500)
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self._stats = {}  # stage -> [count, total ms, max ms, bucket counts]
+
+  def record(self, stage, seconds):
+    ms = seconds * 1000
+    with self._lock:
+      stats = self._stats.get(stage)
+      if stats is None:
+        stats = self._stats[stage] = [0, 0.0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+      stats[0] += 1
+      stats[1] += ms
+      stats[2] = max(stats[2], ms)
+      stats[3][bisect.bisect_left(self.BUCKETS, ms)] += 1
+
+  # Time the code in a "with" block, e.g. "with timings.stage('match'):"
+  def stage(self, name):
+    return _StageTimer(self, name)
+
+  def count(self, stage):
+    with self._lock:
+      return self._stats[stage][0] if stage in self._stats else 0
+
+  # The upper bound of the bucket containing the given percentile
+  def _percentile(self, stats, percent):
+    wanted = stats[0] * percent / 100.0
+    seen = 0
+    for i, n in enumerate(stats[3]):
+      seen += n
+      if n and seen >= wanted:
+        return "<" + str(self.BUCKETS[i]) if i < len(self.BUCKETS) else ">" + str(self.BUCKETS[-1])
+    return "-"
+
+  # The timings as lines of text
+  def report(self):
+    with self._lock:
+      stats = dict((stage, [s[0], s[1], s[2], list(s[3])]) for stage, s in self._stats.items())
+
+    lines = ["{0:<8} {1:>7} {2:>8} {3:>7} {4:>7} {5:>7} {6:>8}".format("stage", "count", "mean ms", "p50", "p90", "p99", "max ms")]
+    for stage in self.STAGES:
+      if stage in stats:
+        s = stats[stage]
+        lines.append("{0:<8} {1:>7} {2:>8.2f} {3:>7} {4:>7} {5:>7} {6:>8.2f}".format(
+          stage, s[0], s[1] / s[0], self._percentile(s, 50), self._percentile(s, 90), self._percentile(s, 99), s[2]))
+
+    lines.append("")
+    labels = ["<" + str(b) for b in self.BUCKETS] + [">" + str(self.BUCKETS[-1])]
+    lines.append("{0:<8} ".format("ms") + " ".join("{0:>6}".format(label) for label in labels))
+    for stage in self.STAGES:
+      if stage in stats:
+        lines.append("{0:<8} ".format(stage) + " ".join("{0:>6}".format(n) for n in stats[stage][3]))
+
+    return lines
+
+
+class _StageTimer():
+
+  def __init__(self, timings, stage):
+    self.timings = timings
+    self.name = stage
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.timings.record(self.name, time.time() - self.start)
+    return False
+
+
+CoronaCompletionTimings = CompletionTimings()
+
+
+#
+# Completion requests
+#
+# Everything find_completions needs from the view and the settings is captured when the request
+# is made, on the main thread, so that the matching can be done in the background
+class CompletionRequest():
+
+  def __init__(self, corona, view):
+    start = time.time()
+    self.docset = _corona_utils.Settings.corona_sdk_use_docset
+    self.strip_white_space = _corona_utils.Settings.corona_sdk_completions_strip_white_space
+    self.use_fuzzy_completion = _corona_utils.Settings.corona_sdk_use_fuzzy_completion
+
+    target_region = corona.current_word_region(view)
+    self.target_start = target_region.begin()
+    self.completion_target = view.substr(target_region)
+    # after a colon only methods make sense
+    self.method_call = self.target_start > 0 and view.substr(self.target_start - 1) == ':'
+
+    # check if text in current line to cursor contains require statement or an open string
+    textToCursor = _sublime_utils.getTextToCursor(view)
+    self.completingRequireStatement = corona._findRequire.search(textToCursor) is not None
+    self.inString = corona.inString(textToCursor)
+    self.extensions = [".lua"]
+    self.followSymlinks = False
+    if self.completingRequireStatement or self.inString:
+      if not self.completingRequireStatement:
+        self.extensions = _corona_utils.Settings.corona_sdk_autocomplete_extensions
+      self.followSymlinks = _corona_utils.Settings.corona_sdk_follow_symlinks
+    CoronaCompletionTimings.record("request", time.time() - start)
+
+
+# Computes completions on a background thread so typing never waits for the docset or the
+# filesystem.  Each view has a generation counter which is bumped by every new request so
+# work for a request that has been overtaken by a later keystroke is abandoned.
+class CompletionWorker(threading.Thread):
+
+  def __init__(self):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self._jobs = coronaQueue.Queue()
+    self._generations = {}
+    self._lock = threading.Lock()
+
+  # 'compute' is called with a function that returns True if the request is stale, 'deliver'
+  # is called with the result (None if the request was abandoned)
+  def submit(self, view_id, compute, deliver):
+    with self._lock:
+      generation = self._generations.get(view_id, 0) + 1
+      self._generations[view_id] = generation
+    self._jobs.put((view_id, generation, compute, deliver, time.time()))
+
+  def forget(self, view_id):
+    with self._lock:
+      self._generations.pop(view_id, None)
+
+  def stop(self):
+    self._jobs.put(None)
+
+  def run(self):
+    while True:
+      job = self._jobs.get()
+      if job is None:
+        break
+      view_id, generation, compute, deliver, submitted = job
+      CoronaCompletionTimings.record("queue", time.time() - submitted)
+      cancelled = lambda: self._generations.get(view_id) != generation
+      result = None
+      if not cancelled():
+        try:
+          result = compute(cancelled)
+        except Exception as e:
+          print("Solar2D Editor: error finding completions ({0})".format(str(e)))
+      deliver(None if cancelled() else result)
+
+
+def GetCompletionWorker():
+  global CoronaCompletionWorker
+  if CoronaCompletionWorker is None:
+    CoronaCompletionWorker = CompletionWorker()
+    CoronaCompletionWorker.start()
+  return CoronaCompletionWorker
+
+
+def plugin_unloaded():
+  global CoronaCompletionWorker
+  if CoronaCompletionWorker is not None:
+    CoronaCompletionWorker.stop()
+    CoronaCompletionWorker = None
 
 
 #
 # CoronaLabs Class
 #
 class CoronaLabs:
-  _completions = []
+  _index = None
+  _source = None
+  _loadLock = threading.Lock()
   _fuzzyMatcher = None
   _fuzzyPrefix = None
-  _findWhiteSpace = re.compile("([^,])\s")
+  _fuzzyThreshold = 5
+  _narrowing = {}
   _findRequire = re.compile("require\s?\(?[\"\']")
   _findStringOpen = re.compile(r'\"|\'')
 
@@ -73,43 +321,73 @@ class CoronaLabs:
 
   # Called by the snippets module to make sure completions are loaded
   def initialize(self):
-    self.load_completions(_corona_utils.GetSetting("corona_sdk_use_docset", default="public"))
+    self.load_completions(_corona_utils.Settings.corona_sdk_use_docset)
 
 
   # If we're running ST2, load completions from file
   # else, load completions from member of package
+  # (the docset is only loaded again if the "corona_sdk_use_docset" setting changes)
   def load_completions(self, docset):
-    # Only load once
-    if (len(self._completions) == 0):
-      source = docset if docset in ['public', 'legacy', 'daily'] else 'public'
-      source = "corona.completions-" + source
+    source = docset if docset in ['public', 'legacy', 'daily'] else 'public'
+    with self._loadLock:
+      if self._index is not None and self._source == source:
+        return
+
+      # The completion index is built from the docset's API file (see gen_completions/mk_sublime_completions.py),
+      # we use the prebuilt index made by gen_completions if we have one that matches it otherwise we build
+      # it from the API entries (and if we don't have an API file, from the Sublime completions file)
+      index = None
+      api_file = "corona.api-" + source
+      api_data = self.load_docset_file(api_file)
+      if api_data is not None:
+        index_data = self.load_docset_file(api_file + _completion_index.INDEX_SUFFIX)
+        if index_data:
+          try:
+            index = _completion_index.load_index(index_data, api_data)
+          except Exception as e:
+            print("Solar2D Editor: failed to load prebuilt index for {0} ({1})".format(api_file, str(e)))
+        if index is None:
+          api = json.loads(api_data.decode('utf-8'))
+          if api.get('format') == _completion_index.API_FORMAT:
+            index = _completion_index.CompletionIndex(api['entries'])
+
+      if index is None:
+        comp_file = "corona.completions-" + source
+        source_data = self.load_docset_file(comp_file)
+        if source_data is None:
+          print("Solar2D Editor: failed to load {0}".format(comp_file))
+          return
+        completions = json.loads(source_data.decode('utf-8'))
+        index = _completion_index.CompletionIndex(completions['completions'])
+
+      self._index = index
+      self._source = source
+
+      # _corona_utils.debug(self._index.triggers)
+      print("Solar2D Editor: loaded {0} completions from the {1} docset".format(len(self._index), source))
+
+  # The contents of one of the docset files in the package (None if it can't be read)
+  def load_docset_file(self, name):
+    try:
       if (_corona_utils.SUBLIME_VERSION < 3000):
-        comp_path = os.path.join(_corona_utils.PACKAGE_DIR, source)
-        json_data = open(comp_path)
-        try:
-          self._completions = json.load(json_data)
-        except Exception as e:
-          print("Solar2D Editor: failed to load {0} ({1})".format(comp_path, str(e)))
-        finally:
-          json_data.close()
-
+        with open(os.path.join(_corona_utils.PACKAGE_DIR, name), "rb") as fd:
+          return fd.read()
       else:
-
-        self._completions = json.loads(sublime.load_resource(_corona_utils.ST_PACKAGE_PATH + source))
-
-      # _corona_utils.debug(self._completions)
-      print("Solar2D Editor: loaded {0} completions from {1}".format(len(self._completions['completions']), source))
+        return sublime.load_binary_resource(_corona_utils.ST_PACKAGE_PATH + name)
+    except Exception as e:
+      _corona_utils.debug("load_docset_file: ", name, ": ", str(e))
+      return None
 
   def setupFuzzyMatch(self, prefix):
-    self._fuzzyMatcher = FuzzyMatcher()
+    if self._fuzzyMatcher is None:
+      self._fuzzyMatcher = FuzzyMatcher()
     self._fuzzyMatcher.setPattern(prefix)
     self._fuzzyPrefix = prefix
 
   def fuzzyMatchString(self, s, use_fuzzy_completion):
     if use_fuzzy_completion:
-      threshold = 5
       score = self._fuzzyMatcher.score(s)
-      if score > threshold:
+      if score > self._fuzzyThreshold:
         # _corona_utils.debug('s: ', s, '; score: ', score)
         return True
       else:
@@ -120,6 +398,11 @@ class CoronaLabs:
       else:
         return False
 
+  # Score the given completions from the index in one batch and return those that match
+  def fuzzyMatchIds(self, ids):
+    scores = self._fuzzyMatcher.score_many([self._index.triggers[i] for i in ids])
+    return [i for i, score in zip(ids, scores) if score > self._fuzzyThreshold]
+
   def inString(self,textToCursor):
     match=self._findStringOpen.findall(textToCursor)
     return len(match)>0 and len(match)%2==1
@@ -133,87 +416,121 @@ class CoronaLabs:
   #  * if there's a period in the "completion target", return only the part following the period in the completions
 
   def find_completions(self, view, prefix):
-    self.load_completions(_corona_utils.GetSetting("corona_sdk_use_docset", default="public"))
-    strip_white_space=_corona_utils.GetSetting("corona_sdk_completions_strip_white_space", default=False)
-    use_fuzzy_completion = _corona_utils.GetSetting("corona_sdk_use_fuzzy_completion", default=True)
+    return self.compute_completions(view, CompletionRequest(self, view))
+
+  # Do the work of finding completions for a request made by CompletionRequest.  This doesn't
+  # depend on the current state of the view so it can be run in the background, in which case
+  # 'cancelled' lets us give up early if a newer request has been made (returning None)
+  def compute_completions(self, view, request, cancelled=lambda: False):
+    with CoronaCompletionTimings.stage("total"):
+      return self.collect_completions(view, request, cancelled)
 
-    completion_target = self.current_word(view)
+  # The stages of compute_completions (timed separately)
+  def collect_completions(self, view, request, cancelled):
+    timings = CoronaCompletionTimings
+
+    with timings.stage("load"):
+      self.load_completions(request.docset)
+    completion_target = request.completion_target
+    use_fuzzy_completion = request.use_fuzzy_completion
 
     # Because we adjust the prefix to make completions with periods in them work better we may need to
     # trim the part before the period from the returned string (or it will appear to be doubled)
     completion_adjustment = "" if "." not in completion_target else completion_target.partition('.')[0] + '.'
 
-    # _corona_utils.debug('prefix: ', prefix, 'completion_target: ', completion_target, "; completion_adjustment: ", completion_adjustment, "; corona_sdk_complete_periods: ", _corona_utils.GetSetting("corona_sdk_complete_periods", True) )
+    # _corona_utils.debug('completion_target: ', completion_target, "; completion_adjustment: ", completion_adjustment, "; corona_sdk_complete_periods: ", _corona_utils.Settings.corona_sdk_complete_periods )
     self.setupFuzzyMatch(completion_target)
 
-    # Sample:
-    #   { "trigger": "audio.stopWithDelay()", "contents": "audio.stopWithDelay( ${1:duration}, ${2:[, options ]} )"},
-    #   "audio.totalChannels ",
-
-    # This is horrible on a variety of levels but is brought upon us by the fact that
-    # ST completion files contain an array that is a mixture of strings and dicts
     comps = []
 
-    # check if text in current line to cursor contains require statement
-    # if so attempt to fill completions with lua formatted file paths
-    textToCursor=_sublime_utils.getTextToCursor(view)
-    completingRequireStatement=self._findRequire.search(textToCursor)
-    inString=self.inString(textToCursor)
-    if completingRequireStatement or inString:
-      extensions=[".lua"]
-      if not completingRequireStatement:
-        extensions=_corona_utils.GetSetting("corona_sdk_autocomplete_extensions",default=[])
-      followSymlinks=_corona_utils.GetSetting("corona_sdk_follow_symlinks",default=False)
-      pathSuggestions=_lua_paths.getFilesAndPaths(view,extensions=extensions,followlinks=followSymlinks,converttoluapaths=completingRequireStatement)
-      for namePath in pathSuggestions:
-        name=namePath[0]
-        luaPath=namePath[1]
-        if self.fuzzyMatchString(name, use_fuzzy_completion) or self.fuzzyMatchString(luaPath, use_fuzzy_completion):
-          comps.append((luaPath,luaPath))
+    # if the text in current line to cursor contains a require statement
+    # attempt to fill completions with lua formatted file paths
+    if request.completingRequireStatement or request.inString:
+      with timings.stage("paths"):
+        pathSuggestions=_lua_paths.getFilesAndPaths(view,extensions=request.extensions,followlinks=request.followSymlinks,converttoluapaths=request.completingRequireStatement)
+        for namePath in pathSuggestions:
+          name=namePath[0]
+          luaPath=namePath[1]
+          if self.fuzzyMatchString(name, use_fuzzy_completion) or self.fuzzyMatchString(luaPath, use_fuzzy_completion):
+            comps.append((luaPath,luaPath))
+
+    if cancelled():
+      return None
 
     # Add textual completions from the document
-    for c in view.extract_completions(completion_target):
-      comps.append((c, c))
+    with timings.stage("extract"):
+      for c in view.extract_completions(completion_target):
+        comps.append((c, c))
 
     # don't add Solar2D API completions if editing a require statement or more generally a string
     # the regex will correctly match multiline strings, but to detect them we need to search more of the document
-    if completingRequireStatement or inString:
+    if request.completingRequireStatement or request.inString:
       return list(set(comps))
 
-    for c in self._completions['completions']:
-      trigger = ""
-      contents = ""
-      if isinstance(c, dict):
-        if self.fuzzyMatchString(c['trigger'], use_fuzzy_completion):
-          trigger = c['trigger']
-          contents = c['contents']
-      elif is_string_instance(c):
-        if self.fuzzyMatchString(c, use_fuzzy_completion):
-          _corona_utils.debug("String match: ", c)
-          trigger = c
-          contents = c
-      if trigger is not "":
-        if strip_white_space and contents is not "":
-           contents = self._findWhiteSpace.sub("\\1", contents)
-        # If we do the completion adjustment on completions that aren't functions
-        # ST somehow erases the text before the period from the document leaving
-        # just the piece after it (it makes no sense).  This fixes that but will
-        # almost certainly have to be changed when ST's behavior changes.
-        if "(" in contents:
-          comps.append((trigger, contents.replace(completion_adjustment, '')))
-        else:
-          comps.append((trigger, contents))
+    if cancelled():
+      return None
+
+    with timings.stage("match"):
+      candidates = self.match_completions(view, request.target_start, completion_target, use_fuzzy_completion)
+      if request.method_call:
+        # (kinds are None if the docset has no API file, in which case we can't tell)
+        kinds = self._index.kinds
+        candidates = [i for i in candidates if kinds[i] is None or kinds[i] == _completion_index.METHOD]
+
+    build_start = time.time()
+    for i in candidates:
+      trigger = self._index.triggers[i]
+      contents = self._index.stripped[i] if request.strip_white_space else self._index.contents[i]
+      # If we do the completion adjustment on completions that aren't functions
+      # ST somehow erases the text before the period from the document leaving
+      # just the piece after it (it makes no sense).  This fixes that but will
+      # almost certainly have to be changed when ST's behavior changes.
+      if "(" in contents:
+        comps.append((trigger, contents.replace(completion_adjustment, '')))
+      else:
+        comps.append((trigger, contents))
 
     # _corona_utils.debug("extract_completions: ", view.extract_completions(completion_target))
 
     # Remove duplicates
     comps = list(set(comps))
+    timings.record("build", time.time() - build_start)
 
     # _corona_utils.debug("comps: ", comps)
 
     return comps
 
+  # Find the docset completions matching the completion target.  If the user has just typed more of
+  # the same word we only need to look at what matched last time (adding characters to the target
+  # can only make the fuzzy score worse) otherwise, e.g. after a backspace or if the cursor has
+  # moved somewhere else, we go back to the index.
+  def match_completions(self, view, target_start, completion_target, use_fuzzy_completion):
+    key = (target_start, use_fuzzy_completion, self._index)
+    last = self._narrowing.get(view.id())
+
+    if last is not None and last[0] == key and completion_target.startswith(last[1]):
+      if use_fuzzy_completion:
+        candidates = self.fuzzyMatchIds(last[2])
+      else:
+        candidates = [i for i in last[2] if self._index.triggers[i].startswith(completion_target)]
+    elif use_fuzzy_completion:
+      candidates = self.fuzzyMatchIds(self._index.fuzzy_candidates(completion_target))
+    else:
+      candidates = self._index.prefix(completion_target)
+
+    self._narrowing[view.id()] = (key, completion_target, candidates)
+
+    return candidates
+
+  def forget_view(self, view):
+    self._narrowing.pop(view.id(), None)
+    if CoronaCompletionWorker is not None:
+      CoronaCompletionWorker.forget(view.id())
+
   def current_word(self, view):
+    return view.substr(self.current_word_region(view))
+
+  def current_word_region(self, view):
     s = view.sel()[0]
 
     # Expand selection to current "word"
@@ -232,22 +549,30 @@ class CoronaLabs:
             and view.classify(end) & sublime.CLASS_LINE_END == 0):
         end += 1
 
-    return view.substr(sublime.Region(start, end))
+    return sublime.Region(start, end)
 
 
 class CoronaLabsCollector(CoronaLabs, sublime_plugin.EventListener):
 
   _first_time = True
+  _findCallName = re.compile(r"([A-Za-z_][\w.:]*)\s*$")
+
+  # Signatures shown for the call the cursor is in, at most this many and only from this much of
+  # the line before the cursor
+  _maxSignatures = 3
+  _maxCallText = 500
 
   def __init__(self, *args, **kw):
     _corona_utils.debug("CoronaLabsCollector: __init__")
     super(CoronaLabsCollector, self).__init__(*args, **kw)
     self.periods_set = {}
+    self._ready_completions = {}
+    self._signatures = {}
 
   def is_lua_file(self, view):
     # Fairly rigorous test for being a Solar2D Lua file
     # If the file has not been saved optionally default to being a Solar2D Lua file
-    return view.match_selector(view.sel()[0].a, "source.lua.corona") if view.file_name() else _corona_utils.GetSetting("corona_sdk_default_new_file_to_corona_lua", default=True)
+    return view.match_selector(view.sel()[0].a, "source.lua.corona") if view.file_name() else _corona_utils.Settings.corona_sdk_default_new_file_to_corona_lua
 
 
   # Optionally trigger a "build" when a .lua file is saved.  This is best
@@ -255,22 +580,27 @@ class CoronaLabsCollector(CoronaLabs, sublime_plugin.EventListener):
   # in the Simulator itself but is provided here for cases where that option
   # doesn't work
   def on_post_save(self, view):
+    # Keep the file index used for path completion up to date
+    _lua_paths.fileChanged(view.file_name())
+
     if self.is_lua_file(view):
-      auto_build = _corona_utils.GetSetting("corona_sdk_auto_build", default=False)
+      auto_build = _corona_utils.Settings.corona_sdk_auto_build
       if auto_build:
         _corona_utils.debug("Solar2D Editor: auto build triggered")
         view.window().run_command("build")
 
-    if view.file_name().lower().endswith(".lua") and _corona_utils.GetSetting("corona_sdk_default_new_file_to_corona_lua", default=True):
+    if view.file_name().lower().endswith(".lua") and _corona_utils.Settings.corona_sdk_default_new_file_to_corona_lua:
       view.set_syntax_file('Packages/' + _corona_utils.PACKAGE_NAME + '/CoronaSDKLua.sublime-syntax')
 
   # When a Lua file is loaded and the "use_periods_in_completion" user preference is set,
   # add period to "auto_complete_triggers" if it's not already there.
   def on_load(self, view):
-    use_corona_sdk_completion = _corona_utils.GetSetting("corona_sdk_completion", default=True)
+    _lua_paths.fileChanged(view.file_name())
+
+    use_corona_sdk_completion = _corona_utils.Settings.corona_sdk_completion
 
     if use_corona_sdk_completion and self.is_lua_file(view):
-      use_periods_in_completion = _corona_utils.GetSetting("corona_sdk_complete_periods", default=True)
+      use_periods_in_completion = _corona_utils.Settings.corona_sdk_complete_periods
 
       # Completion behavior is improved if periods are included in the completion process
       if use_periods_in_completion:
@@ -290,6 +620,9 @@ class CoronaLabsCollector(CoronaLabs, sublime_plugin.EventListener):
 
   # When a Lua file is closed and we added a period to "auto_complete_triggers", remove it
   def on_close(self, view):
+    self.forget_view(view)
+    self._ready_completions.pop(view.id(), None)
+    self._signatures.pop(view.id(), None)
     _corona_utils.debug("on_close view: ", view.file_name(), "periods_set" if self.periods_set.get(view.file_name(), False) else "not set" )
     if view.file_name() is not None and self.periods_set.get(view.file_name(), False):
       auto_complete_triggers = view.settings().get("auto_complete_triggers")
@@ -298,8 +631,46 @@ class CoronaLabsCollector(CoronaLabs, sublime_plugin.EventListener):
         self.periods_set[view.file_name()] = False
 
 
+  # Show how the Solar2D API function the cursor is in the arguments of can be called in the status
+  # bar.  Nothing is shown until the docset has been loaded for completion.
+  def on_selection_modified(self, view):
+    if self._index is None:
+      return
+
+    signature = None
+    sel = view.sel()
+    if _corona_utils.Settings.corona_sdk_signature_help and len(sel) > 0 and view.match_selector(sel[0].begin(), "source.lua.corona"):
+      call = self.enclosing_call(_sublime_utils.getTextToCursor(view)[-self._maxCallText:])
+      if call is not None:
+        signatures = self._index.signatures_for(call)
+        if signatures:
+          more = len(signatures) - self._maxSignatures
+          signature = "  |  ".join(signatures[:self._maxSignatures]) + ("  (+{0} more)".format(more) if more > 0 else "")
+
+    if signature != self._signatures.get(view.id()):
+      self._signatures[view.id()] = signature
+      if signature is None:
+        view.erase_status("corona_signature")
+      else:
+        view.set_status("corona_signature", signature)
+
+  # The name of the function being called at the end of 'text' (before the cursor), e.g.
+  # "display.newText" for 'display.newText( "Hello", x' (None if we're not in a call)
+  def enclosing_call(self, text):
+    depth = 0
+    for i in range(len(text) - 1, -1, -1):
+      ch = text[i]
+      if ch == ')':
+        depth += 1
+      elif ch == '(':
+        if depth == 0:
+          match = self._findCallName.search(text, 0, i)
+          return match.group(1) if match is not None else None
+        depth -= 1
+    return None
+
   def on_query_completions(self, view, prefix, locations):
-    use_corona_sdk_completion = _corona_utils.GetSetting("corona_sdk_completion", True)
+    use_corona_sdk_completion = _corona_utils.Settings.corona_sdk_completion
 
     if self._first_time and use_corona_sdk_completion:
       if not self.is_lua_file(view) and view.file_name().lower().endswith(".lua"):
@@ -308,10 +679,65 @@ class CoronaLabsCollector(CoronaLabs, sublime_plugin.EventListener):
         print(msg)
         self._first_time = False
 
-    _corona_utils.debug("on_query_completions: ",  "use_corona_sdk_completion: ", use_corona_sdk_completion, "source.lua.corona - entity: ", view.match_selector(locations[0], "source.lua.corona - entity"))
+    if _corona_utils.Settings.corona_sdk_debug:
+      _corona_utils.debug("on_query_completions: ",  "use_corona_sdk_completion: ", use_corona_sdk_completion, "source.lua.corona - entity: ", view.match_selector(locations[0], "source.lua.corona - entity"))
     if use_corona_sdk_completion and view.match_selector(locations[0], "source.lua.corona - entity"):
-      comps = self.find_completions(view, prefix)
       flags = 0  # sublime.INHIBIT_EXPLICIT_COMPLETIONS | sublime.INHIBIT_WORD_COMPLETIONS
-      return (comps, flags)
+      if _corona_utils.SUBLIME_VERSION < 3000:
+        return (self.find_completions(view, prefix), flags)
+      else:
+        return self.query_completions_async(view, flags)
     else:
       return []
+
+  # Hand the request to the completion worker.  On ST4 we can return a CompletionList that's filled
+  # in when the results arrive, on ST3 we return nothing for now and trigger completion again once
+  # the results are ready
+  def query_completions_async(self, view, flags):
+    worker = GetCompletionWorker()
+
+    if hasattr(sublime, "CompletionList"):
+      request = CompletionRequest(self, view)
+      completion_list = sublime.CompletionList()
+      def deliver(comps):
+        sublime.set_timeout(lambda: completion_list.set_completions(comps or [], flags), 0)
+      worker.submit(view.id(), lambda cancelled: self.compute_completions(view, request, cancelled), deliver)
+      return completion_list
+
+    state = (view.sel()[0].begin(), view.change_count())
+    ready = self._ready_completions.pop(view.id(), None)
+    if ready is not None and ready[0] == state:
+      return (ready[1], flags)
+
+    request = CompletionRequest(self, view)
+    def deliver(comps):
+      if comps is not None:
+        sublime.set_timeout(lambda: self.show_completions(view, state, comps), 0)
+    worker.submit(view.id(), lambda cancelled: self.compute_completions(view, request, cancelled), deliver)
+    return []
+
+  # Called on the main thread with the results of a background request, if the user hasn't
+  # moved on in the meantime get ST to ask for completions again (which will return them)
+  def show_completions(self, view, state, comps):
+    if not view.is_valid() or (view.sel()[0].begin(), view.change_count()) != state:
+      return
+    self._ready_completions[view.id()] = (state, comps)
+    view.run_command("hide_auto_complete")
+    view.run_command("auto_complete", {"disable_auto_insert": True, "next_completion_if_showing": False})
+
+
+# Show how long each stage of finding completions has been taking in the console (and debug.log
+# if "corona_sdk_debug" is set)
+class CoronaCompletionTimingsCommand(sublime_plugin.WindowCommand):
+
+  def run(self, reset=False):
+    if reset:
+      CoronaCompletionTimings.reset()
+      sublime.status_message("Solar2D Editor: completion timings reset")
+      return
+
+    print("Solar2D Editor: completion timings")
+    for line in CoronaCompletionTimings.report():
+      print(line)
+      _corona_utils.debug("completion timings: " + line)
+    self.window.run_command("show_panel", {"panel": "console"})
@@ -12,9 +12,12 @@ import os
 import re
 import threading
 import subprocess
-import datetime
 import sys
 import socket
+import select
+import errno
+import codecs
+import difflib
 import traceback
 
 try:
@@ -31,8 +34,10 @@ debuggerCmdQ = None
 
 try:
   from . import _corona_utils  # P3
+  from . import _corona_log  # P3
 except:
   import _corona_utils  # P2
+  import _corona_log  # P2
 
 
 # determine if 'obj' is a string in both Python 2.x and 3.x
@@ -43,64 +48,346 @@ def is_string_instance(obj):
     return isinstance(obj, str)
 
 
-statusRegion = None
+# How often (in ms) queued output is written to the debugger panes
+PANE_FRAME_INTERVAL = 50
+
+paneOutputLock = threading.Lock()
+paneOutputScheduled = False
+paneViews = {}  # pane name -> view
+paneText = {}  # pane name -> what was last written to the Variables and Lua Stack panes
 
 # We change our behavior to avoid complications with certain Solar2D releases
 corona_sdk_version = None
-# Getting settings in certain threads locks up Sublime Text so do it just once
-corona_sdk_debug = _corona_utils.GetSetting("corona_sdk_debug", False)
-
-debugFP = None
 
-def debug(s):
-  global debugFP
-  global corona_sdk_debug
-  try:
-    if not debugFP and corona_sdk_debug:
-      if not os.path.isdir(_corona_utils.PACKAGE_USER_DIR):
-        os.makedirs(_corona_utils.PACKAGE_USER_DIR)
-      debugFP = open(os.path.normpath(os.path.join(_corona_utils.PACKAGE_USER_DIR, "debug.log")), "w", 1)
-  except:
-    pass
-
-  # <CoronaDebuggerThread(Thread-5, started 4583960576)>
-  thread_id = re.sub(r'.*\(([^,]*),.*', r'\1', str(threading.current_thread()))
-  log_line = str(datetime.datetime.now()) + " (" + str(thread_id) + "): " + str(s)
-  if debugFP:
-    debugFP.write(log_line + "\n")
-  _corona_utils.debug(log_line)
-
-
-def debug_with_stacktrace(s):
-  debug(s)
-  for line in traceback.format_list(traceback.extract_stack()):
-    debug("    "+line.strip())
+# Messages go to the console and debug.log (see _corona_log), 'args' are formatted into 's' with %
+# only if debugging is on
+debug = _corona_log.debug
+debug_with_stacktrace = _corona_log.stacktrace
 
 HOST = ''    # Symbolic name meaning all available interfaces
 PORT = 8171  # Arbitrary non-privileged port, matches Simulator
 
+# Size of the reads done by ProtocolReader
+RECV_SIZE = 65536
+
+# Size of the reads of the Simulator's output done by CoronaSubprocessThread
+SUBPROCESS_READ_SIZE = 65536
+
+# How long (in seconds) StopSubprocess waits for the Simulator's output to end, it's called on the
+# main thread and anything the Simulator started can keep the output open after it has gone
+SUBPROCESS_STOP_TIMEOUT = 1.0
+
 coronaDbg = None
 coronaDbgThread = None
-coronaBreakpointsSettings = None
-coronaBreakpoints = {}
+
+
+# Reads the debugger protocol from the Simulator's socket.  Responses are a status line, e.g.
+# "202 Paused main.lua 3", sometimes followed by a body whose length ends the status line ("200 OK 1234").
+# Reads are buffered and bodies are read straight into a buffer of the right size and then decoded
+# in one go so large responses (e.g. the locals of a big table) are quick to read and UTF-8 sequences
+# split across reads are decoded correctly.  The socket is non-blocking, receive() is called when
+# select() says it's readable and nextLine()/nextBody() return None until there's enough data.
+class ProtocolReader(object):
+
+  def __init__(self, sock):
+    self.sock = sock
+    self._buffer = bytearray()
+    self._scanned = 0  # how much of the buffer we know doesn't contain a newline
+    self._body = None
+    self._bodyView = None
+    self._have = 0
+
+  # Do one read from the socket, returns False at end of file
+  def receive(self):
+    try:
+      if self._body is not None and self._have < len(self._body):
+        if self._bodyView is not None:
+          n = self.sock.recv_into(self._bodyView[self._have:], len(self._body) - self._have)
+        else:
+          chunk = self.sock.recv(min(len(self._body) - self._have, RECV_SIZE))
+          n = len(chunk)
+          self._body[self._have:self._have + n] = chunk
+        self._have += n
+        return n > 0
+      chunk = self.sock.recv(RECV_SIZE)
+    except socket.error as e:
+      if e.args and e.args[0] in WOULD_BLOCK:
+        return True
+      raise
+    self._buffer.extend(chunk)
+    return len(chunk) > 0
+
+  def nextLine(self):
+    end = self._buffer.find(b"\n", self._scanned)
+    if end == -1:
+      self._scanned = len(self._buffer)
+      return None
+    line = self._buffer[:end + 1]
+    del self._buffer[:end + 1]
+    self._scanned = 0
+    return line.decode('utf-8', 'replace')
+
+  # Start reading a body of 'length' bytes
+  def expectBody(self, length):
+    self._body = bytearray(length)
+    self._have = min(len(self._buffer), length)
+    self._body[:self._have] = self._buffer[:self._have]
+    del self._buffer[:self._have]
+    self._scanned = 0
+    try:
+      self._bodyView = memoryview(self._body)  # P3 (and Python 2.7)
+    except NameError:
+      self._bodyView = None  # P2.6
+
+  def nextBody(self):
+    if self._body is None or self._have < len(self._body):
+      return None
+    body = self._body.decode('utf-8', 'replace')
+    self._body = None
+    self._bodyView = None
+    return body
+
+
+# errno values for a non-blocking socket that isn't ready after all
+WOULD_BLOCK = set(getattr(errno, name) for name in ["EAGAIN", "EWOULDBLOCK", "WSAEWOULDBLOCK"] if hasattr(errno, name))
+
+
+# A pair of connected sockets, used to wake up a thread waiting in select() (socket.socketpair()
+# isn't available on Windows before Python 3.5)
+def socket_pair():
+  try:
+    return socket.socketpair()
+  except (AttributeError, socket.error):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+      listener.bind(("127.0.0.1", 0))
+      listener.listen(1)
+      sender = socket.create_connection(listener.getsockname())
+      receiver, addr = listener.accept()
+    finally:
+      listener.close()
+    return receiver, sender
+
+
+# A response we're waiting for from the Simulator
+class DebuggerRequest(object):
+
+  # What the response looks like
+  LINE = "line"    # a status line, e.g. "200 OK"
+  DATA = "data"    # a status line ending with the length of a body that follows it, e.g. "200 OK 1234"
+  PAUSE = "pause"  # where the program has stopped, e.g. "202 Paused main.lua 3" (an error,
+                   # "401 Error in Execution 1234", is followed by a body)
+
+  _findLength = re.compile(r'^(\d+)[^0-9]*(\d+)$')
+  _findError = re.compile(r'^(401) Error in Execution (\d+)$')
+  _findStatus = re.compile(r'^(\d+)')
+
+  def __init__(self, command, kind):
+    self.command = command
+    self.kind = kind
+    self.response = None  # the status line ('' if the connection closed before it arrived)
+    self.status = None    # the status code (for DATA responses, only if it had a length)
+    self.body = None
+    self._done = threading.Event()
+
+  # Parse the response from the data the reader has, returns False if it hasn't all arrived
+  def parse(self, reader):
+    if self.response is None:
+      line = reader.nextLine()
+      if line is None:
+        return False
+      self.response = line
+      if self.kind == self.DATA:
+        matches = self._findLength.search(line.strip())
+      elif self.kind == self.PAUSE:
+        matches = self._findError.search(line.strip())
+      else:
+        matches = None
+      if matches is None:
+        if self.kind != self.DATA:
+          statusMatches = self._findStatus.search(line)
+          self.status = statusMatches.group(1) if statusMatches else None
+        return True
+      self.status = matches.group(1)
+      reader.expectBody(int(matches.group(2)))
+
+    self.body = reader.nextBody()
+    return self.body is not None
+
+  def finish(self):
+    if self.response is None:
+      self.response = ""
+    self._done.set()
+
+  def wait(self):
+    # (waiting with a timeout lets Python 2 threads be interrupted)
+    while not self._done.is_set():
+      self._done.wait(1)
+    return self
+
+
+# The connection to the Simulator.  All the socket I/O happens in this thread which waits in
+# select() for the Simulator to connect, for responses to arrive or for requests to be sent.
+# Requests can be sent without waiting for the responses to earlier ones (the Simulator answers
+# them in order) and closing the transport wakes it up immediately rather than at the next poll.
+class DebuggerTransport(threading.Thread):
+
+  def __init__(self, listener):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.listener = listener
+    self.conn = None
+    self.reader = None
+    self.connected = threading.Event()  # set when the Simulator connects or we give up
+    self._lock = threading.Lock()
+    self._pending = []  # requests in the order their responses will arrive
+    self._outgoing = bytearray()
+    self._closed = False
+    self._wakeReceiver, self._wakeSender = socket_pair()
+
+  def isConnected(self):
+    return self.conn is not None and not self._closed
+
+  # Send 'command' (if it's not None) and return a DebuggerRequest for each of the responses it
+  # gets (the kinds of response are given by 'kinds')
+  def request(self, command, *kinds):
+    return self.send([command], [DebuggerRequest(command, kind) for kind in kinds])
+
+  # Send all the commands in one write, each gets one response of the given kind
+  def requestEach(self, commands, kind):
+    return self.send(commands, [DebuggerRequest(command, kind) for command in commands])
+
+  def send(self, commands, requests):
+    with self._lock:
+      if self._closed or self.conn is None:
+        for request in requests:
+          request.finish()
+        return requests
+      self._pending.extend(requests)
+      for command in commands:
+        if command is not None:
+          try:
+            self._outgoing.extend(str.encode(command + "\n", 'utf-8'))
+          except TypeError:
+            self._outgoing.extend(command + "\n")  # P2
+    self.wake()
+    return requests
+
+  def close(self):
+    with self._lock:
+      self._closed = True
+    self.wake()
+
+  def wake(self):
+    try:
+      self._wakeSender.send(b"x")
+    except socket.error:
+      pass
+
+  def run(self):
+    try:
+      if self.accept():
+        self.serve()
+    except Exception as e:
+      debug("DebuggerTransport: %s", e)
+    finally:
+      with self._lock:
+        self._closed = True
+        pending = self._pending
+        self._pending = []
+      for request in pending:
+        request.finish()
+      for s in [self.conn, self.listener, self._wakeReceiver, self._wakeSender]:
+        if s is not None:
+          try:
+            s.close()
+          except socket.error:
+            pass
+      self.connected.set()
+      debug("DebuggerTransport: ends")
+
+  def drainWakeups(self):
+    try:
+      self._wakeReceiver.recv(RECV_SIZE)
+    except socket.error:
+      pass
+
+  def accept(self):
+    debug("Socket about to accept")
+    while not self._closed:
+      readable, writable, errors = select.select([self.listener, self._wakeReceiver], [], [])
+      if self._wakeReceiver in readable:
+        self.drainWakeups()
+      if self.listener in readable and not self._closed:
+        self.conn, addr = self.listener.accept()
+        self.conn.setblocking(False)
+        self.reader = ProtocolReader(self.conn)
+        debug('Connected with %s:%s', addr[0], addr[1])
+        self.connected.set()
+        return True
+    return False
+
+  def serve(self):
+    while True:
+      with self._lock:
+        if self._closed:
+          return
+        sending = len(self._outgoing) > 0
+
+      readable, writable, errors = select.select([self.conn, self._wakeReceiver], [self.conn] if sending else [], [])
+
+      if self._wakeReceiver in readable:
+        self.drainWakeups()
+
+      if self.conn in writable:
+        with self._lock:
+          try:
+            sent = self.conn.send(bytes(self._outgoing))
+          except socket.error as e:
+            if not e.args or e.args[0] not in WOULD_BLOCK:
+              raise
+            sent = 0
+          del self._outgoing[:sent]
+
+      if self.conn in readable:
+        if not self.reader.receive():
+          debug("DebuggerTransport: connection closed by the Simulator")
+          return
+        self.dispatch()
+
+  # Hand out the responses which have arrived
+  def dispatch(self):
+    while True:
+      with self._lock:
+        if not self._pending:
+          return
+        request = self._pending[0]
+      if not request.parse(self.reader):
+        return
+      with self._lock:
+        self._pending.pop(0)
+      debug("response to %s: %s", request.command, request.response.strip())
+      request.finish()
 
 
 class CoronaDebuggerThread(threading.Thread):
 
-  def __init__(self, projectDir, completionCallback, threadID=1):
+  def __init__(self, projectDir, completionCallback, threadID=1, breakpoints=None):
     threading.Thread.__init__(self)
     self.threadID = threadID
     self.projectDir = projectDir
+    self.breakpoints = breakpoints or {}  # the breakpoints to set when we connect
     self.completionCallback = completionCallback
     self.debugger_running = False
-    self.conn = None
     self.socket = None
-    self.recvFP = None
-    self.sendFP = None
+    self.transport = None
+    self.useLocalsCommand = False  # the Simulator can't run VARIABLES_LUA so use LOCALS
 
   def stop(self):
     # debug_with_stacktrace("CoronaDebuggerThread: stop")
     self.debugger_running = False
+    if self.transport is not None:
+      self.transport.close()
 
   def isRunning(self):
     # debug("CoronaDebuggerThread: isRunning (" + str(self.debugger_running) + ")")
@@ -118,7 +405,8 @@ class CoronaDebuggerThread(threading.Thread):
     try:
       self.socket.bind((HOST, PORT))
     except socket.error as msg:
-      debug('Bind: ' + str(msg))
+      debug('Bind: %s', msg)
+      self.socket.close()
       sublime.error_message("Cannot connect to Solar2D Simulator (" + str(msg) + ")\n\nPerhaps there is another debugger running.\n\nTry restarting Sublime Text and stopping any Simulators.")
       return False
     else:
@@ -127,71 +415,24 @@ class CoronaDebuggerThread(threading.Thread):
     self.socket.listen(1)
     debug('Socket now listening')
 
+    self.transport = DebuggerTransport(self.socket)
     return True
 
-  def initPUTComms(self):
-    if _corona_utils.SUBLIME_VERSION < 3000:
-      self.recvFP = self.conn.makefile('r', 1)
-      self.sendFP = self.conn.makefile('w', 1)
-    else:
-      self.recvFP = self.conn.makefile(mode='rb', buffering=0, newline='\n')
-      self.sendFP = self.conn.makefile(mode='wb', buffering=0, newline='\n')
-
-  def closePUTComms(self):
-    if self.sendFP is not None:
-      self.sendFP.close()
-      self.sendFP = None
-    if self.recvFP is not None:
-      self.recvFP.close()
-      self.recvFP = None
-
-  def writeToPUT(self, s):
-    try:
-      return self.sendFP.write(str.encode(s, 'utf-8'))
-    except TypeError:
-      return self.sendFP.write(s)
-
-  def readFromPUT(self, n=None):
-    try:
-      if n is not None:
-        result = self.recvFP.read(n)
-      else:
-        result = self.recvFP.readline()
-    except Exception as e:
-      debug("readFromPUT: " + str(e))
-    else:
-      return result.decode('utf-8')
-
   def run(self):
 
-    # wait to accept a connection - set a short timeout so we can be interrupted if plans change
-    self.socket.settimeout(1)
-    debug("Socket about to accept")
-    while self.socket is not None:
-      try:
-        self.conn, addr = self.socket.accept()
-        self.conn.settimeout(None)  # Revert to no timeout once things are established
-      except socket.error as msg:
-        debug('Accept: ' + str(msg))
-      else:
-        debug('Socket accepted')
-        break
-
-    if self.socket is None:
+    # wait for the Simulator to connect (or for stop() to be called)
+    self.transport.start()
+    self.transport.connected.wait()
+    if not self.transport.isConnected():
       return
 
-    # display client information
-    debug('Connected with ' + addr[0] + ':' + str(addr[1]))
-
-    self.initPUTComms()
-
-    self.writeToPUT("STEP\n")
+    ack, pause = self.transport.request("STEP", DebuggerRequest.LINE, DebuggerRequest.PAUSE)
 
-    data = self.readFromPUT()  # response like '200 OK'
-    debug('data: ' + str(data))
+    data = ack.wait().response  # response like '200 OK'
+    debug('data: %s', data)
 
-    bpResponse = self.readFromPUT()  # response like '202 Paused /path/to/project/main.lua 3\n'
-    debug('bpResponse: ' + bpResponse)
+    bpResponse = pause.wait().response  # response like '202 Paused /path/to/project/main.lua 3\n'
+    debug('bpResponse: %s', bpResponse)
 
     bpMatches = re.search(r'^202 Paused\s+(.+?)\s+(\d+)$', bpResponse.strip())
 
@@ -200,7 +441,7 @@ class CoronaDebuggerThread(threading.Thread):
       filename = bpMatches.group(1)
       line = bpMatches.group(2)
 
-      debug("run: filename {0}, line {1}".format(filename, line))
+      debug("run: filename %s, line %s", filename, line)
 
       if not filename.endswith("main.lua"):  # we get a pause in "init.lua" if there's a syntax error in main.lua
         debugger_status("Error running main.lua")
@@ -209,20 +450,19 @@ class CoronaDebuggerThread(threading.Thread):
       else:
         debugger_status("Paused at line {0} of {1}".format(line, filename))
         on_main_thread(lambda: self.showSublimeContext(filename, int(line)))
+    elif pause.status == "401":
+      console_output("Error in remote application: ")
+      console_output(pause.body)
     else:
-      errMatches = re.search(r'^401 Error in Execution (\d+)$', bpResponse.strip())
-      if errMatches is not None:
-        size = errMatches.group(1)
-        console_output("Error in remote application: ")
-        console_output(self.readFromPUT(size))
-      else:
-        print("Solar2D Editor Error: ", bpResponse)
-        on_main_thread(lambda: sublime.error_message("Unexpected response from Simulator:\n\n" + str(bpResponse) + "\n\nCheck Console for error messages."))
+      print("Solar2D Editor Error: ", bpResponse)
+      on_main_thread(lambda: sublime.error_message("Unexpected response from Simulator:\n\n" + str(bpResponse) + "\n\nCheck Console for error messages."))
 
     # Restore any breakpoint we have saved (breakpoints can only be set when
     # we are running the debugger though we allow the user to think they are
-    # setting breakpoints before it's started)
-    on_main_thread(lambda: self.restore_breakpoints())
+    # setting breakpoints before it's started).  These go in the same batch
+    # as the backtrace and locals
+    if self.breakpoints:
+      self.doCommand('restoreb')
 
     self.doCommand('backtrace')
     # Skip displaying local variables on problematic releases (if we know what it is)
@@ -232,33 +472,14 @@ class CoronaDebuggerThread(threading.Thread):
       self.doCommand('locals')
 
     while self.debugger_running:
-      cmd = debuggerCmdQ.get()
-      self.performCommand(cmd)
-      debuggerCmdQ.task_done()
+      self.performCommands(debuggerCmdQ.get())
 
     # clean up on PUT termination
+    self.transport.close()
     on_main_thread(lambda: self.completionCallback(self.threadID))
 
     debug('CoronaDebuggerThread: ends')
 
-  def restore_breakpoints(self):
-    global coronaBreakpointsSettings
-    if coronaBreakpointsSettings is None:
-      coronaBreakpointsSettings = sublime.load_settings(_corona_utils.PACKAGE_NAME + ".breakpoints")
-    if coronaBreakpointsSettings is not None:
-      debug("coronaBreakpointsSettings: "+str(coronaBreakpointsSettings))
-      if coronaBreakpointsSettings.get('breakpoints') is not None:
-        # Restore previously set breakpoints(use a local rather than "coronaBreakpoints"
-        # so we don't toggle any existing ones off again)
-        breakpoints = coronaBreakpointsSettings.get('breakpoints')
-        debug("breakpoints: "+str(breakpoints))
-        for filename in breakpoints:
-          for view in sublime.active_window().views():
-            debug("view.name: " + str(view.file_name()) + "; filename: " + filename)
-            if view.file_name() == filename:
-              breakpoints[filename] = sorted(set(breakpoints[filename]))  # sort and unique
-              for line in breakpoints[filename]:
-                sublime.active_window().run_command("corona_debugger", {"cmd": "setb", "arg_filename": filename, "arg_lineno": line, "arg_toggle": False})
 
   def getBreakpointParameters(self, cmdLine):
     cmd = ""
@@ -288,34 +509,77 @@ class CoronaDebuggerThread(threading.Thread):
 
     return cmd, parameter
 
-  def getAck(self, cmd):
-    ack = None
-    try:
-      self.writeToPUT(cmd.upper() + "\n")
-      ack = self.readFromPUT().strip()
-    except Exception as e:
-      debug("Exception reading network: "+str(e))
-    else:
-      debug("getAck: " + ack)
-      if ack != "200 OK":
-        debug("*** Sent '{0}' got unexpected '{1}'".format(cmd, ack))
-
-    return ack
-
   def doCommand(self, cmd):
     debuggerCmdQ.put(cmd, 1)
 
-  def performCommand(self, cmd):
+  # Commands after which the program runs (or the debugger goes away) so there's no point sending
+  # anything else until we've heard back
+  def isBlockingCommand(self, cmd):
+    return cmd.partition(" ")[0].lower() in ["run", "step", "over", "exit"]
+
+  # Send 'cmd' and any other commands waiting in the queue without waiting for the responses (e.g.
+  # "backtrace", "locals" and any breakpoints being restored all go at once) then handle the
+  # responses in order
+  def performCommands(self, cmd):
+    batch = []
+    while True:
+      batch.append((cmd, self.sendCommand(cmd)))
+      if self.isBlockingCommand(cmd):
+        break
+      try:
+        cmd = debuggerCmdQ.get_nowait()
+      except coronaQueue.Empty:
+        break
+
+    for cmd, requests in batch:
+      self.performCommand(cmd, requests)
+      debuggerCmdQ.task_done()
+
+  # Returns the DebuggerRequests for the responses to the command (None if nothing was sent)
+  def sendCommand(self, cmd):
     try:
       verb = cmd.partition(" ")[0].lower()
       if verb in ["run", "step", "over"]:
-        self.doContinue(cmd)
-      elif verb in ["backtrace", "locals"]:
-        self.doGetData(cmd)
+        return self.sendContinue(cmd)
+      elif verb in ["backtrace"] or (verb == "locals" and self.useLocalsCommand):
+        return self.transport.request(cmd.upper(), DebuggerRequest.DATA)
+      elif verb in ["locals"]:
+        # The local variables (and upvalues) are the environment DUMP runs in
+        return self.transport.request(variables_command("getfenv(1)", 1), DebuggerRequest.DATA)
+      elif verb in ["expand"]:
+        cmdtype, expr = self.getParameters(cmd)
+        return self.transport.request(variables_command(expr, VARIABLES_EXPAND_DEPTH), DebuggerRequest.DATA)
       elif verb in ["setb", "delb"]:
-        self.doSetBreakpoint(cmd)
+        cmdtype, filename, linenum = self.getBreakpointParameters(cmd)
+        if filename and linenum:
+          return self.transport.request(cmdtype.upper() + " " + filename + " " + linenum, DebuggerRequest.LINE)
+      elif verb in ["restoreb"]:
+        return self.transport.requestEach(self.breakpointCommands(), DebuggerRequest.LINE)
       elif verb in ["dump"]:
-        self.doDump(cmd)
+        cmdtype, variable_name = self.getParameters(cmd)
+        if variable_name:
+          return self.transport.request(variables_command(variable_name, VARIABLES_EXPAND_DEPTH), DebuggerRequest.DATA)
+    except Exception as e:
+      debug("Exception sending command: %s", e)
+    return None
+
+  def performCommand(self, cmd, requests):
+    try:
+      verb = cmd.partition(" ")[0].lower()
+      if verb in ["run", "step", "over"]:
+        self.doContinue(cmd, requests)
+      elif verb in ["backtrace"] or (verb == "locals" and requests[0].command == "LOCALS"):
+        self.doGetData(cmd, requests)
+      elif verb in ["locals"]:
+        self.doGetVariables(cmd, requests)
+      elif verb in ["expand"]:
+        self.doExpand(cmd, requests)
+      elif verb in ["setb", "delb"]:
+        self.doSetBreakpoint(cmd, requests)
+      elif verb in ["restoreb"]:
+        self.doRestoreBreakpoints(requests)
+      elif verb in ["dump"]:
+        self.doDump(cmd, requests)
       elif verb in ["exit"]:
         self.doExit(cmd)
       elif verb in ["frame"]:
@@ -323,47 +587,70 @@ class CoronaDebuggerThread(threading.Thread):
       else:
         debugger_status("Unhandled command: {0}".format(cmd))
     except Exception as e:
-      debug("Exception performing command: "+str(e))
+      debug("Exception performing command: %s", e)
       type_, value_, traceback_ = sys.exc_info()
       for line in traceback.format_tb(traceback_):
-        debug("    "+line.strip())
+        debug("    %s", line.strip())
 
-  def doDump(self, cmd):
+  def doDump(self, cmd, requests):
     cmdtype, variable_name = self.getParameters(cmd)
-    debug("doDump: "+cmdtype+" "+variable_name)
-    if variable_name:
-      # Note the space after "return" matters
-      # self.writeToPUT("EXEC return (" + variable_name + ")\n")
-      self.writeToPUT("DUMP return (" + variable_name + ")\n")
-      dmpResponse = self.readFromPUT().strip()
-      debug("dmpResponse: " + dmpResponse)
-      dataMatches = re.search(r'^(\d+)[^0-9]*(\d+)$', dmpResponse)
-      if dataMatches is not None:
-        status = dataMatches.group(1)
-        length = int(dataMatches.group(2))
-        if status == "200":
-          if length == 0:
-            debugger_status("No "+cmd)
+    debug("doDump: %s %s", cmdtype, variable_name)
+    if requests is not None:
+      request = requests[0].wait()
+      dmpResponse = request.response.strip()
+      debug("dmpResponse: %s", dmpResponse)
+      if not dmpResponse:
+        return  # the connection has gone
+      if request.status is not None:
+        if request.status == "200":
+          debug('dmpData: %s', request.body)
+          root = parse_variables(request.body, variable_name, variable_name)
+          if root is None:
+            debugger_status("Error getting value of " + variable_name)
           else:
-            dataStr = ""
-            while len(dataStr) < length:
-              dataStr += self.readFromPUT(int(length - len(dataStr)))
-
-            dataStr = dataStr
-            debug('dmpData: ' + dataStr)
-            sublime.message_dialog(dataStr)
+            coronaVariables.inspect(root)
+            variables_output(coronaVariables.render())
       else:
         debugger_status("Error getting variable value: " + dmpResponse)
     else:
       debugger_status("Usage: DUMP variable")
 
-  def doSetBreakpoint(self, cmd):
-    global coronaBreakpoints
+  # The local variables when the program pauses, if the Simulator doesn't give us a result we
+  # understand we use LOCALS instead (which gives us text to show as is)
+  def doGetVariables(self, cmd, requests):
+    request = requests[0].wait()
+    debug("variablesResponse: %s", request.response.strip())
+    if not request.response:
+      return  # the connection has gone
+    root = parse_variables(request.body, "Locals", "") if request.status == "200" else None
+    if root is None:
+      debug("doGetVariables: falling back to LOCALS")
+      self.useLocalsCommand = True
+      self.doGetData(cmd, [self.transport.request("LOCALS", DebuggerRequest.DATA)[0]])
+      return
+    coronaVariables.setLocals(root)
+    variables_output(coronaVariables.render())
+
+  # The elements of a table being expanded in the Variables pane
+  def doExpand(self, cmd, requests):
+    cmdtype, expr = self.getParameters(cmd)
+    request = requests[0].wait()
+    if not request.response:
+      return  # the connection has gone
+    root = parse_variables(request.body, expr, expr) if request.status == "200" else None
+    if root is None or root.children is None:
+      debugger_status("Error getting value of " + expr)
+      return
+    coronaVariables.setChildren(expr, root)
+    variables_output(coronaVariables.render())
+
+  def doSetBreakpoint(self, cmd, requests):
     cmdtype, filename, linenum = self.getBreakpointParameters(cmd)
-    if filename and linenum:
-      self.writeToPUT(cmdtype.upper() + " " + filename + " " + linenum + "\n")
-      bpResponse = self.readFromPUT().strip()
-      debug("bpResponse: " + bpResponse)
+    if requests is not None:
+      bpResponse = requests[0].wait().response.strip()
+      debug("bpResponse: %s", bpResponse)
+      if not bpResponse:
+        return  # the connection has gone
       if bpResponse == "200 OK":
         action = "set" if cmdtype.upper() == "SETB" else "removed"
         debugger_status("Breakpoint {2} at {0}:{1}".format(filename, linenum, action))
@@ -372,42 +659,46 @@ class CoronaDebuggerThread(threading.Thread):
     else:
       debugger_status("Usage: [SETB|DELB] filename linenum")
 
+  def breakpointCommands(self):
+    commands = []
+    for filename in sorted(self.breakpoints):
+      for linenum in self.breakpoints[filename]:
+        commands.append('SETB "' + filename + '" ' + str(linenum))
+    return commands
+
+  def doRestoreBreakpoints(self, requests):
+    failed = 0
+    for request in requests:
+      bpResponse = request.wait().response.strip()
+      if not bpResponse:
+        return  # the connection has gone
+      if bpResponse != "200 OK":
+        debug("Error restoring breakpoint: %s (%s)", request.command, bpResponse)
+        failed += 1
+    if failed:
+      debugger_status("Restored {0} breakpoints ({1} could not be set)".format(len(requests) - failed, failed))
+    else:
+      debugger_status("Restored {0} breakpoints".format(len(requests)))
+
   def doExit(self, cmd):
     debug("CoronaDebugger: doExit")
-    try:
-      # self.closePUTComms()
-      if self.conn is not None:
-        # debug("doExit: conn.close")
-        self.conn.close()
-        self.conn = None
-      if self.socket is not None:
-        # debug("doExit: socket.close")
-        # self.socket.shutdown(socket.SHUT_RDWR)
-        self.socket.close()
-        self.socket = None
-    except Exception as e:
-      debug("Exception closing down coprocess: "+str(e))
-      exc_type, exc_obj, exc_tb = sys.exc_info()
-      fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-      print(exc_type, fname, exc_tb.tb_lineno)
-
-  def doGetData(self, cmd):
-    # backtrace and locals overload the 200 response with a length so we need
-    # to send them manually rather than use getAck()
-    self.writeToPUT(cmd.upper() + "\n")
-    dataResponse = self.readFromPUT().strip()
-    debug("dataResponse: " + dataResponse)
-    dataMatches = re.search(r'^(\d+)[^0-9]*(\d+)$', dataResponse)
-    if dataMatches is not None:
-      status = dataMatches.group(1)
-      length = int(dataMatches.group(2))
-      if status == "200":
-        if length == 0:
+    # the transport closes the connection and the listening socket
+    self.transport.close()
+    self.socket = None
+
+  def doGetData(self, cmd, requests):
+    # backtrace and locals overload the 200 response with a length
+    request = requests[0].wait()
+    dataResponse = request.response.strip()
+    debug("dataResponse: %s", dataResponse)
+    if not dataResponse:
+      return  # the connection has gone
+    if request.status is not None:
+      dataStr = request.body
+      if request.status == "200":
+        if not dataStr:
           debugger_status("No "+cmd)
         else:
-          dataStr = ""
-          while len(dataStr) < length:
-            dataStr += self.readFromPUT(int(length - len(dataStr)))
           if cmd == 'backtrace':
             # Tidy up backtrace
             if dataStr.find('platform/resources/init.lua:') != -1 or dataStr.find('?:0') != -1:
@@ -427,7 +718,7 @@ class CoronaDebuggerThread(threading.Thread):
       debugger_status("Unparsable response from '" + cmd + "' (" + dataResponse + ")")
 
   def activateViewWithFile(self, filename, line):
-    debug("activateViewWithFile: "+str(filename) + ":" + str(line))
+    debug("activateViewWithFile: %s:%s", filename, line)
     window = sublime.active_window()
     for view in window.views():
       if view.name() == filename:
@@ -441,7 +732,7 @@ class CoronaDebuggerThread(threading.Thread):
       window.focus_view(view)
 
   def showSublimeContext(self, filename, line):
-    debug("showSublimeContext: "+str(filename) + " : " + str(line))
+    debug("showSublimeContext: %s : %s", filename, line)
     console_output("@@@ Stopped at "+str(filename.replace(self.projectDir+"/", "")) + ":" + str(line) +" @@@")
     window = sublime.active_window()
     if window:
@@ -463,8 +754,11 @@ class CoronaDebuggerThread(threading.Thread):
       else:
         debug("No current view")
 
-  # Handle category of commands that move the execution pointer ("run", "step", "over")
-  def doContinue(self, cmd):
+  # Handle category of commands that move the execution pointer ("run", "step", "over"), we get
+  # an acknowledgement and then, when the program stops again, where it stopped
+  def sendContinue(self, cmd):
+    # What we know about the variables is out of date once the program runs
+    coronaVariables.clear()
     if cmd == "run":
       stack_output("Running ...")
       variables_output("Running ...")
@@ -472,8 +766,16 @@ class CoronaDebuggerThread(threading.Thread):
       on_main_thread(lambda: sublime.active_window().active_view().erase_regions("current_line"))  # we wont be back to erase the current line marker so do it here
       on_main_thread(lambda: console_output("@@@ Running - Shift+F10 to stop @@@"))
 
-    self.getAck(cmd)
-    response = self.readFromPUT()
+    return self.transport.request(cmd.upper(), DebuggerRequest.LINE, DebuggerRequest.PAUSE)
+
+  def doContinue(self, cmd, requests):
+    ack, pause = requests
+    ack = ack.wait().response.strip()
+    debug("getAck: %s", ack)
+    if ack and ack != "200 OK":
+      debug("*** Sent '%s' got unexpected '%s'", cmd, ack)
+
+    response = pause.wait().response
     if response is None or response == "":
       debugger_status("Program finished")
       self.debugger_running = False
@@ -481,14 +783,14 @@ class CoronaDebuggerThread(threading.Thread):
 
     statusMatches = re.search(r'^(\d+)', response.strip())
     status = statusMatches.group(0)
-    debug("Status: " + status)
+    debug("Status: %s", status)
     if status == "202":
       bpMatches = re.search(r'^202 (\w+)\s+(.+)\s+(\d+)$', response)
       if bpMatches is not None:
         label = bpMatches.group(1)
         filename = bpMatches.group(2)
         line = bpMatches.group(3)
-        debug("doContinue: label: {0}, filename {1}, line {2} ({3})".format(label, filename, line, response))
+        debug("doContinue: label: %s, filename %s, line %s (%s)", label, filename, line, response)
         if label == "Error":
           label = "Runtime script error"
         if filename and line:
@@ -513,23 +815,389 @@ class CoronaDebuggerThread(threading.Thread):
       else:
         debugger_status("Unexpected 203 response: " + response)
     elif status == "401":
-      errMatches = re.search(r'^401 Error in Execution (\d+)$', response)
-      if errMatches:
-        size = errMatches.group(1)
-        if size:
-          console_output("Error in remote application: ")
-          console_output(self.readFromPUT(int(size)))
+      if pause.body:
+        console_output("Error in remote application: ")
+        console_output(pause.body)
 
   def doRun(self):
-    self.doContinue("RUN")
+    self.doCommand("run")
 
   def doStep(self):
-    self.doContinue("STEP")
+    self.doCommand("step")
+
+
+# Limits on what's fetched from the Simulator for the Variables pane: when the program pauses we
+# get just the names, types and values of the local variables, when a table is expanded we get its
+# elements and theirs (VARIABLES_EXPAND_DEPTH levels) but no more than VARIABLES_MAX_ELEMENTS in all
+VARIABLES_EXPAND_DEPTH = 2
+VARIABLES_MAX_ELEMENTS = 200
+VARIABLES_VALUE_LENGTH = 80
+
+# Lua run in the Simulator (with DUMP) to describe a value.  The tables are walked breadth first and
+# each element is a record "id|parent id|key type|key|type|value" (a table's value is the number of
+# elements it has, counted up to the limit).  When the limit is reached the table being walked gets a
+# record "id|more" and nothing else is walked.  The values are cleaned of characters that might be
+# escaped when the result is sent to us and the records are bracketed by "@@CE[" and "]CE@@".
+# Note: this has to go on one line and %s is replaced by the expression
+VARIABLES_LUA = " ".join(line.strip() for line in r"""
+(function(v, depth, limit)
+  local function clean(x)
+    local ok, s = pcall(tostring, x)
+    if not ok then s = '?' end
+    return (string.gsub(string.sub(s, 1, %(length)d), '[%%c|~"\\]', ' '))
+  end
+  local function describe(x)
+    if type(x) ~= 'table' then return clean(x) end
+    local c = 0
+    for _ in pairs(x) do c = c + 1 if c > limit then break end end
+    return c
+  end
+  local out, queue, i, n = { '0|0|string||' .. type(v) .. '|' .. describe(v) }, {}, 1, 0
+  if type(v) == 'table' then queue[1] = { v, 0, 0 } end
+  while queue[i] do
+    local t, id, level = queue[i][1], queue[i][2], queue[i][3]
+    i = i + 1
+    for k, x in pairs(t) do
+      if n >= limit then out[#out + 1] = id .. '|more' queue = {} break end
+      n = n + 1
+      out[#out + 1] = n .. '|' .. id .. '|' .. type(k) .. '|' .. clean(k) .. '|' .. type(x) .. '|' .. describe(x)
+      if type(x) == 'table' and level + 1 < depth then queue[#queue + 1] = { x, n, level + 1 } end
+    end
+  end
+  return '@@CE[' .. table.concat(out, '~') .. ']CE@@'
+end)(%(value)s, %(depth)d, %(limit)d)
+""".strip().splitlines())
+
+_findVariables = re.compile(r'@@CE\[(.*?)\]CE@@', re.S)
+_findIdentifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+# The DUMP command to describe the value of the Lua expression 'value'
+def variables_command(value, depth, limit=VARIABLES_MAX_ELEMENTS):
+  # Note the space after "return" matters
+  return "DUMP return (" + VARIABLES_LUA % {'value': value, 'depth': depth, 'limit': limit, 'length': VARIABLES_VALUE_LENGTH} + ")"
+
+
+# A value shown in the Variables pane, 'children' is None until a table's elements have been fetched
+class VariableNode(object):
+
+  def __init__(self, name, expr, vtype, value):
+    self.name = name
+    self.expr = expr  # the Lua expression for the value (None if it can't be written)
+    self.type = vtype
+    self.value = value
+    self.children = None
+    self.truncated = False  # there are elements we didn't get
+    self.expanded = False
+
+  def isTable(self):
+    return self.type == "table"
+
+  def sortKey(self):
+    if self.name.startswith("["):
+      try:
+        return (0, float(self.name[1:-1]), "")
+      except ValueError:
+        pass
+    return (1, 0, self.name)
+
+  def describe(self):
+    if not self.isTable():
+      return "{0} ({1}) = {2}".format(self.name, self.type, self.value)
+    if self.value == "0":
+      return "{0} (table, empty)".format(self.name)
+    if self.value.isdigit() and int(self.value) > VARIABLES_MAX_ELEMENTS:
+      return "{0} (table, {1}+ items)".format(self.name, VARIABLES_MAX_ELEMENTS)
+    return "{0} (table, {1} item{2})".format(self.name, self.value, "" if self.value == "1" else "s")
+
+
+# The Lua expression for the element 'key' of the table 'expr'
+def element_expr(expr, keyType, key):
+  if expr is None:
+    return None
+  if keyType == "number":
+    return expr + "[" + key + "]"
+  if keyType != "string":
+    return None  # keys which are tables, functions, etc can't be written
+  if expr == "":
+    return key  # a local variable
+  if _findIdentifier.match(key):
+    return expr + "." + key
+  return expr + '["' + key + '"]'
+
+
+# Turn the result of the Lua in VARIABLES_LUA into a VariableNode for the expression 'expr' (None if
+# it's not there, e.g. there was an error running it)
+def parse_variables(body, name, expr):
+  match = _findVariables.search(body or "")
+  if match is None:
+    return None
+  nodes = {}
+  for record in match.group(1).split("~"):
+    fields = record.split("|")
+    if len(fields) == 2 and fields[1] == "more" and fields[0] in nodes:
+      nodes[fields[0]].truncated = True
+    elif len(fields) == 6:
+      nid, parentId, keyType, key, vtype, value = fields
+      if nid == "0":
+        nodes[nid] = VariableNode(name, expr, vtype, value)
+        if vtype == "table" and value == "0":
+          nodes[nid].children = []
+        continue
+      parent = nodes.get(parentId)
+      if parent is None:
+        continue
+      node = VariableNode("[" + key + "]" if keyType == "number" else key, element_expr(parent.expr, keyType, key), vtype, value)
+      if vtype == "table" and value == "0":
+        node.children = []
+      if parent.children is None:
+        parent.children = []
+      parent.children.append(node)
+      nodes[nid] = node
+
+  for node in nodes.values():
+    if node.children is not None:
+      node.children.sort(key=VariableNode.sortKey)
+      # We have none of the elements of a table that was being walked when we ran out
+      if node.truncated and not node.children:
+        node.children = None
+  return nodes.get("0")
+
+
+# What's shown in the Variables pane: the local variables where the program is paused and anything
+# inspected with "Inspect Variable".  Tables are fetched when they're first expanded and kept until
+# the program is resumed.
+class VariablesInspector(object):
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._locals = None
+    self._inspected = []
+    self._lines = []  # the node on each line of the pane (None for headings)
+
+  def clear(self):
+    with self._lock:
+      self._locals = None
+      self._inspected = []
+      self._lines = []
+
+  def setLocals(self, root):
+    with self._lock:
+      self._locals = root
+      root.expanded = True
+
+  def inspect(self, root):
+    with self._lock:
+      self._inspected = [node for node in self._inspected if node.expr != root.expr]
+      self._inspected.insert(0, root)
+      root.expanded = True
+
+  # The node for a table that's been fetched and every node with the same expression (it might be
+  # both a local and inspected)
+  def setChildren(self, expr, fetched):
+    with self._lock:
+      for node in self.__find(expr):
+        node.children = fetched.children
+        node.truncated = fetched.truncated
+        node.expanded = True
+
+  def __find(self, expr):
+    found = []
+    pending = [node for node in [self._locals] + self._inspected if node is not None]
+    while pending:
+      node = pending.pop()
+      if node.expr == expr:
+        found.append(node)
+      if node.children:
+        pending.extend(node.children)
+    return found
+
+  def nodeAt(self, row):
+    with self._lock:
+      return self._lines[row] if 0 <= row < len(self._lines) else None
+
+  # Returns the text for the pane
+  def render(self):
+    with self._lock:
+      lines = []
+      self._lines = []
+      if self._inspected:
+        lines.append("Inspect:")
+        self._lines.append(None)
+        for node in self._inspected:
+          self.__render(node, 0, lines)
+      if self._locals is not None:
+        lines.append("Locals:")
+        self._lines.append(None)
+        for node in self._locals.children or []:
+          self.__render(node, 0, lines)
+        if self._locals.truncated:
+          self.__more(0, lines)
+      return "\n".join(lines) + "\n"
+
+  def __render(self, node, depth, lines):
+    if node.isTable() and node.value != "0":
+      marker = "- " if node.expanded else "+ "
+    else:
+      marker = "  "
+    lines.append("  " * depth + marker + node.describe())
+    self._lines.append(node)
+    if node.expanded and node.children is not None:
+      for child in node.children:
+        self.__render(child, depth + 1, lines)
+      if node.truncated:
+        self.__more(depth + 1, lines)
+
+  def __more(self, depth, lines):
+    lines.append("  " * depth + "  ... (more not shown)")
+    self._lines.append(None)
+
+
+coronaVariables = VariablesInspector()
+
+
+# How long (in ms) to wait after the breakpoints change before saving them, so a burst of changes
+# (e.g. editing above the breakpoints in a file) is written once
+BREAKPOINTS_SAVE_DELAY = 2000
+
+# The region key for the breakpoint markers in a view
+BREAKPOINTS_REGION = "corona_breakpoints"
+
+
+# The breakpoints for each file, saved in "<package name>.breakpoints".  Views of files with
+# breakpoints have a marker on each breakpoint's line.  All of a view's markers are one set of regions
+# which Sublime Text moves as lines are inserted or deleted so we can read back the new line numbers.
+class BreakpointStore(object):
+
+  def __init__(self):
+    self._files = None  # filename -> set of line numbers (loaded when first needed)
+    self._views = None  # filename -> view of the file (maintained by CoronaDebuggerListener)
+    self._settings = None
+    self._saveScheduled = False
+
+  def __load(self):
+    if self._files is None:
+      self._settings = sublime.load_settings(_corona_utils.PACKAGE_NAME + ".breakpoints")
+      saved = self._settings.get('breakpoints') or {}
+      self._files = {}
+      for filename in saved:
+        if saved[filename]:
+          self._files[filename] = set(int(line) for line in saved[filename])
+    return self._files
+
+  def files(self):
+    return sorted(self.__load())
+
+  def lines(self, filename):
+    return sorted(self.__load().get(filename, ()))
+
+  def contains(self, filename, lineno):
+    return lineno in self.__load().get(filename, ())
+
+  def add(self, filename, lineno):
+    lines = self.__load().setdefault(filename, set())
+    if lineno not in lines:
+      lines.add(lineno)
+      self.changed(filename)
+
+  def remove(self, filename, lineno):
+    lines = self.__load().get(filename)
+    if lines is not None and lineno in lines:
+      lines.discard(lineno)
+      if not lines:
+        del self._files[filename]
+      self.changed(filename)
+
+  # Update the file's markers and save the breakpoints (soon)
+  def changed(self, filename):
+    view = self.viewForFile(filename)
+    if view is not None:
+      self.markView(view)
+    if not self._saveScheduled:
+      self._saveScheduled = True
+      sublime.set_timeout(self.save, BREAKPOINTS_SAVE_DELAY)
+
+  def save(self):
+    self._saveScheduled = False
+    breakpoints = {}
+    for filename in self.__load():
+      breakpoints[filename] = sorted(self._files[filename])
+    debug("saving breakpoints: %s", breakpoints)
+    self._settings.set("breakpoints", breakpoints)
+    sublime.save_settings(_corona_utils.PACKAGE_NAME + ".breakpoints")
+
+  def __viewMap(self):
+    if self._views is None:
+      self._views = {}
+      for window in sublime.windows():
+        for view in window.views():
+          if view.file_name() is not None and view.file_name() not in self._views:
+            self._views[view.file_name()] = view
+            if view.file_name() in self.__load():
+              self.markView(view)
+    return self._views
+
+  def viewForFile(self, filename):
+    return self.__viewMap().get(filename)
+
+  # Called when a view is loaded, activated or saved (possibly under a new name)
+  def viewOpened(self, view):
+    filename = view.file_name()
+    views = self.__viewMap()
+    if filename is None or (filename in views and views[filename].id() == view.id()):
+      return
+    self.viewClosed(view)
+    views[filename] = view
+    if filename in self.__load():
+      self.markView(view)
+
+  def viewClosed(self, view):
+    views = self.__viewMap()
+    for filename in [f for f in views if views[f].id() == view.id()]:
+      del views[filename]
+
+  def markView(self, view):
+    regions = [view.line(view.text_point(lineno - 1, 0)) for lineno in self.lines(view.file_name())]
+    if _corona_utils.SUBLIME_VERSION < 3000:
+      # Path for icons is "Packages/Theme - Default/"
+      view.add_regions(BREAKPOINTS_REGION, regions, "breakpoint", "../"+_corona_utils.PACKAGE_NAME+"/CoronaBP", sublime.HIDDEN)
+    else:
+      view.add_regions(BREAKPOINTS_REGION, regions, "breakpoint", "Packages/"+_corona_utils.PACKAGE_NAME+"/CoronaBP.png", sublime.HIDDEN)
+
+  # Called when a view is edited, pick up the lines the markers (if any) have moved to
+  def viewModified(self, view):
+    filename = view.file_name()
+    if filename is None or filename not in self.__load():
+      return
+    regions = view.get_regions(BREAKPOINTS_REGION)
+    if not regions:
+      return  # not marked yet
+    lines = set(view.rowcol(region.begin())[0] + 1 for region in regions)
+    if lines != self._files[filename] or len(regions) != len(lines):
+      debug("breakpoints in %s moved to %s", filename, sorted(lines))
+      self._files[filename] = lines
+      self.changed(filename)
+
+
+coronaBreakpoints = BreakpointStore()
 
 
 class CoronaDebuggerListener(sublime_plugin.EventListener):
+  def on_load(self, view):
+    coronaBreakpoints.viewOpened(view)
+
+  def on_activated(self, view):
+    coronaBreakpoints.viewOpened(view)
+
+  def on_close(self, view):
+    coronaBreakpoints.viewClosed(view)
+
+  def on_modified(self, view):
+    coronaBreakpoints.viewModified(view)
+
   def on_post_save(self, view):
-    debug("CoronaDebuggerListener:on_post_save: " + view.file_name())
+    debug("CoronaDebuggerListener:on_post_save: %s", view.file_name())
+    coronaBreakpoints.viewOpened(view)  # it may have been saved under a new name
     if (coronaDbg is not None and coronaDbg.isRunning()) and view.file_name().endswith(".lua"):
       if sublime.ok_cancel_dialog(view.file_name() + " has changed.  Do you want to restart the Debugger?", "Restart"):
         sublime.set_timeout(lambda: sublime.active_window().run_command("corona_debugger", {"cmd": "restart"}), 0)
@@ -551,10 +1219,9 @@ class CoronaDebuggerCommand(sublime_plugin.WindowCommand):
       return False
 
   def run(self, cmd=None, arg_filename=None, arg_lineno=None, arg_toggle=True):
-    debug("CoronaDebuggerCommand: " + cmd)
+    debug("CoronaDebuggerCommand: %s", cmd)
     global coronaDbg
     global corona_sdk_version
-    global corona_sdk_debug
     self.view = self.window.active_view()
 
     if self.view is None:
@@ -566,7 +1233,7 @@ class CoronaDebuggerCommand(sublime_plugin.WindowCommand):
       cmd = "start"
 
     if cmd == "start":
-      if corona_sdk_debug:
+      if _corona_utils.Settings.corona_sdk_debug:
         # Show Sublime Console
         self.window.run_command("show_panel", {"panel": "console"})
         # sublime.log_commands(True)
@@ -608,12 +1275,12 @@ class CoronaDebuggerCommand(sublime_plugin.WindowCommand):
       dbg_cmd = [dbg_path]
       dbg_cmd += dbg_flags
       dbg_cmd.append(mainlua)
-      debug("debugger cmd: " + str(dbg_cmd))
+      debug("debugger cmd: %s", dbg_cmd)
 
-      debug("dbg_version: " + str(dbg_version))
+      debug("dbg_version: %s", dbg_version)
       if dbg_version:
         corona_sdk_version = dbg_version.rpartition(".")[2]
-        debug("corona_sdk_version: " + str(corona_sdk_version))
+        debug("corona_sdk_version: %s", corona_sdk_version)
 
       global consoleOutputQ, variablesOutputQ, luaStackOutputQ, debuggerCmdQ
       consoleOutputQ = coronaQueue.Queue()
@@ -621,7 +1288,7 @@ class CoronaDebuggerCommand(sublime_plugin.WindowCommand):
       luaStackOutputQ = coronaQueue.Queue()
       debuggerCmdQ = coronaQueue.Queue()
 
-      coronaDbg = CoronaDebuggerThread(projectDir, self.debuggerFinished)
+      coronaDbg = CoronaDebuggerThread(projectDir, self.debuggerFinished, breakpoints=self.restore_breakpoints(projectDir))
       if coronaDbg.setup():
         if self.window.num_groups() == 1:
           self.initializeWindowPanes()
@@ -672,7 +1339,7 @@ class CoronaDebuggerCommand(sublime_plugin.WindowCommand):
 
       cmd += " " + '"' + filename + '"'
       cmd += " " + str(lineno)
-      debug("setb: " + cmd)
+      debug("setb: %s", cmd)
 
       if coronaDbg is not None:
         coronaDbg.doCommand(cmd)
@@ -681,7 +1348,7 @@ class CoronaDebuggerCommand(sublime_plugin.WindowCommand):
       print("CoronaDebuggerCommand: Unrecognized command: " + cmd)
 
   def debuggerFinished(self, threadId):
-    debug("debuggerFinished: threadId: " + str(threadId))
+    debug("debuggerFinished: threadId: %s", threadId)
     self.closeWindowPanes()
     # self.window.run_command("corona_debugger", {"cmd": "exit"})
 
@@ -701,55 +1368,31 @@ class CoronaDebuggerCommand(sublime_plugin.WindowCommand):
       else:
         sublime.error_message("Corona Debugger is not running")
 
+  # The saved breakpoints in the project's files (whether or not they're open), {filename: [line numbers]},
+  # to be set when the debugger connects
+  def restore_breakpoints(self, projectDir):
+    restored = {}
+    projectPrefix = os.path.normcase(os.path.join(projectDir, ""))
+    for filename in coronaBreakpoints.files():
+      view = coronaBreakpoints.viewForFile(filename)
+      if view is not None:
+        coronaBreakpoints.markView(view)
+      if os.path.normcase(filename).startswith(projectPrefix) and os.path.isfile(filename):
+        restored[filename] = coronaBreakpoints.lines(filename)
+    debug("breakpoints: %s", restored)
+
+    return restored
+
   def toggle_breakpoint(self, filename, lineno, toggle=True):
-    global coronaBreakpointsSettings
-    global coronaBreakpoints
-    result = True
-
-    if coronaBreakpointsSettings is None:
-      coronaBreakpointsSettings = sublime.load_settings(_corona_utils.PACKAGE_NAME + ".breakpoints")
-
-    bpId = self.new_breakpoint_id(filename, lineno)
-    debug("bpId: " + bpId)
-    if filename not in coronaBreakpoints:
-      coronaBreakpoints[filename] = []
-    if lineno in coronaBreakpoints[filename] and toggle:
+    if toggle and coronaBreakpoints.contains(filename, lineno):
       # we're unsetting the breakpoint
       debug("toggle_breakpoint: unsetting breakpoint")
-      coronaBreakpoints[filename].remove(lineno)
-      view = self.view_for_file(filename)
-      if view is not None:
-        view.erase_regions(bpId)
-      result = False
+      coronaBreakpoints.remove(filename, lineno)
+      return False
     else:
-      debug("toggle_breakpoint: setting breakpoint in '"+filename+"' at "+str(lineno) )
-      if lineno not in coronaBreakpoints[filename]:
-        coronaBreakpoints[filename].append(int(lineno))
-      view = self.view_for_file(filename)
-      if view is not None:
-        mark = [view.line(view.text_point(lineno - 1, 0))]
-        if _corona_utils.SUBLIME_VERSION < 3000:
-          # Path for icons is "Packages/Theme - Default/"
-          view.add_regions(bpId, mark, "breakpoint", "../"+_corona_utils.PACKAGE_NAME+"/CoronaBP", sublime.HIDDEN)
-        else:
-          view.add_regions(bpId, mark, "breakpoint", "Packages/"+_corona_utils.PACKAGE_NAME+"/CoronaBP.png", sublime.HIDDEN)
-      result = True
-
-    # Save the breakpoints for posterity
-    debug("coronaBreakpoints: " + str(coronaBreakpoints))
-    coronaBreakpointsSettings.set("breakpoints", coronaBreakpoints)
-    sublime.save_settings(_corona_utils.PACKAGE_NAME + ".breakpoints")
-
-    return result
-
-  def view_for_file(self, filename):
-    for view in sublime.active_window().views():
-      if view.file_name() == filename:
-        return view
-    return None
-
-  def new_breakpoint_id(self, filename, lineno):
-    return filename + str(lineno)
+      debug("toggle_breakpoint: setting breakpoint in '%s' at %s", filename, lineno)
+      coronaBreakpoints.add(filename, lineno)
+      return True
 
   def initializeWindowPanes(self):
     self.window.set_layout({"cols":[0,0.6,1],"rows":[0,0.5,0.7,1],"cells":[[0,0,2,1],[0,1,2,2],[0,2,1,3],[1,2,2,3]]})
@@ -774,9 +1417,15 @@ class CoronaDebuggerCommand(sublime_plugin.WindowCommand):
         view.set_scratch(True)
         view.run_command("toggle_setting", {"setting": "line_numbers"})
         self.window.set_view_index(view, w['group'], 0)
+        if w['title']:
+          paneViews[w['title']] = view
+        if w['tag'] == 'variables':
+          view.settings().set('_corona_debugger_variables', True)
         # outputToPane(w['title'], "this is " + w['title'])
 
   def closeWindowPanes(self):
+    paneViews.clear()
+    paneText.clear()
     closed_panes = False # try to only close panes we created
     if self.window.num_groups() > 1:
       for view in self.window.views():
@@ -785,7 +1434,7 @@ class CoronaDebuggerCommand(sublime_plugin.WindowCommand):
         closed_panes = True
         group, index = self.window.get_view_index(view)
         if group > 0:
-          debug("Closing: " + view.name())
+          debug("Closing: %s", view.name())
           self.window.focus_view(view)
           self.window.run_command("close_file")
       if closed_panes:
@@ -796,7 +1445,7 @@ class CoronaDebuggerCommand(sublime_plugin.WindowCommand):
 
 
 def debugger_status(msg):
-  debug("debugger_status: " + msg)
+  debug("debugger_status: %s", msg)
   sublime.set_timeout(lambda: sublime.status_message(msg), 0)
 
 
@@ -804,15 +1453,20 @@ def on_main_thread(callee):
   sublime.set_timeout(callee, 0)
 
 
+# The first "Solar2D Simulator[pid:tid] " on each line
+_findSimulatorPrefix = re.compile(r'^(.*?)Solar2D Simulator\[\d+:\d+\] ', re.M)
+
+
+# 'text' can be any number of lines
 def console_output(text):
   if consoleOutputQ is not None:
     # if the line doesn't end with a newline, add one
     if text[-1] != "\n":
       text += "\n"
     # Remove cruft from Simulator output (also CRs which are coming from somewhere)
-    text = re.sub(r'Solar2D Simulator\[\d+:\d+\] ', '', text.replace("\r", ""), 1)
+    text = _findSimulatorPrefix.sub(r'\1', text.replace("\r", ""))
     consoleOutputQ.put(text, 1)
-    sublime.set_timeout(lambda: outputToPane('Console', None, False), 0)
+    schedule_pane_output()
 
 
 def variables_output(text):
@@ -821,7 +1475,7 @@ def variables_output(text):
     if text[-1] != "\n":
       text += "\n"
     variablesOutputQ.put(text, 1)
-    sublime.set_timeout(lambda: outputToPane('Variables', None, True), 0)
+    schedule_pane_output()
 
 
 def stack_output(text):
@@ -830,68 +1484,192 @@ def stack_output(text):
     if text[-1] != "\n":
       text += "\n"
     luaStackOutputQ.put(text, 1)
-    sublime.set_timeout(lambda: outputToPane('Lua Stack', None, True), 0)
+    schedule_pane_output()
 
 
-def outputToPane(name, text, erase=True):
-  debug("outputToPane: name: '" + name + "' text: " + str(text))
-  global statusRegion
-  queueing = False
-  if text is None:
-    if name == "Variables":
-      subProcOutputQ = variablesOutputQ
-    elif name == "Lua Stack":
-      subProcOutputQ = luaStackOutputQ
+# Output is queued by whichever thread produces it and written to the panes at most once per
+# frame so a chatty app doesn't mean an edit (and a redraw) for every line it prints
+def schedule_pane_output():
+  global paneOutputScheduled
+  with paneOutputLock:
+    if paneOutputScheduled:
+      return
+    paneOutputScheduled = True
+  sublime.set_timeout(flush_pane_output, PANE_FRAME_INTERVAL)
+
+
+# Everything currently in a queue
+def drain_queue(q):
+  items = []
+  while q is not None:
+    try:
+      items.append(q.get_nowait())
+    except coronaQueue.Empty:
+      break
+    q.task_done()
+  return items
+
+
+def flush_pane_output():
+  global paneOutputScheduled
+  # Anything queued after this will schedule another flush
+  with paneOutputLock:
+    paneOutputScheduled = False
+
+  # The Variables and Lua Stack panes are replaced each time so only the latest output matters
+  for name, q in [('Variables', variablesOutputQ), ('Lua Stack', luaStackOutputQ)]:
+    items = drain_queue(q)
+    if items:
+      outputToPane(name, items[-1], True)
+
+  # Console lines are appended in as few edits as possible, status lines ("@@@ Running ... @@@")
+  # are written separately as they replace the previous one
+  pending = []
+  for text in drain_queue(consoleOutputQ):
+    if "@@@ " in text:
+      if pending:
+        outputToPane('Console', "".join(pending), False)
+        pending = []
+      outputToPane('Console', text, False)
     else:
-      subProcOutputQ = consoleOutputQ
-    text = subProcOutputQ.get()
-    queueing = True
-  debug("outputToPane: name: '" + name + "' text: " + text)
+      pending.append(text)
+  if pending:
+    outputToPane('Console', "".join(pending), False)
+
+
+# The view showing a debugger pane, the views are remembered when the panes are created so we
+# don't have to look through the window's views each time we output something
+def pane_view(name):
+  view = paneViews.get(name)
+  if view is not None and view.window() is not None:
+    return view
+  paneViews.pop(name, None)
   window = sublime.active_window()
+  if window is None:
+    return None
   for view in window.views():
-    # only reload view if text has changed
-    if view.name() == name and view.substr(sublime.Region(0, view.size())) != text:
-      view.set_read_only(False)
-      # Remove the last status we output
-      if statusRegion and "@@@ " in text:
-          view.sel().clear()
-          view.sel().add(view.full_line(statusRegion))
-          view.run_command("right_delete")
-          statusRegion = None
-      if _corona_utils.SUBLIME_VERSION < 3000:
-        edit = view.begin_edit()
-        # print("name: ", name, "size: ", view.size())
-        if erase:
-          view.erase(edit, sublime.Region(0, view.size()))
-          view.insert(edit, 0, text)
-        else:
-          view.insert(edit, view.size(), text)
-        view.end_edit(edit)
-      else:  # It's ST3
-        if erase:
-          view.run_command("select_all")
-          view.run_command("right_delete")
-        view.run_command('append', {'characters': text})
+    if view.name() == name and view.settings().get('_corona_debugger_pane'):
+      paneViews[name] = view
+      return view
+  return None
 
+
+def outputToPane(name, text, erase=True):
+  debug("outputToPane: name: '%s' text: %s", name, text)
+  view = pane_view(name)
+  if view is None:
+    return
+  # only reload a replaced pane if its text has changed
+  if erase:
+    if paneText.get(name) == text:
+      return
+    paneText[name] = text
+  maxLines = 0 if erase else _corona_utils.Settings.corona_sdk_debugger_console_max_lines
+  view.run_command("corona_debugger_pane_output", {"text": text, "erase": erase, "max_lines": maxLines})
+
+
+# Writes to a debugger pane in a single edit, the Console pane is kept to the last 'max_lines'
+# lines (if it's not 0) by trimming the oldest.  The Variables and Lua Stack panes ('erase') are
+# updated by replacing only the lines that have changed.
+class CoronaDebuggerPaneOutputCommand(sublime_plugin.TextCommand):
+
+  def run(self, edit, text, erase=False, max_lines=0):
+    view = self.view
+    view.set_read_only(False)
+
+    if erase:
+      self.replaceLines(edit, text)
       view.set_read_only(True)
-      # view.set_viewport_position((0, view.size())) # scroll to the end
-      view.show(view.size(), True)  # scroll to the end, works better on Windows
-
-      # Highlight status line and remember where it is so it can be removed later
-      if "@@@ " in text:
-        line = view.rowcol(view.size())[0]
-        pt = view.text_point(line-1, 0)
-        statusRegion = view.line(sublime.Region(pt))
-        view.sel().clear()
-        view.sel().add(view.line(statusRegion))
-        mark = [sublime.Region(view.size() - 1, view.size())]
-        if _corona_utils.SUBLIME_VERSION < 3000:
-          # Path for icons is "Packages/Theme - Default/"
-          view.add_regions('dbg', mark, "debugger", "../"+_corona_utils.PACKAGE_NAME+"/CoronaBP", sublime.HIDDEN)
-        else:
-          view.add_regions('dbg', mark, "debugger", "Packages/"+_corona_utils.PACKAGE_NAME+"/CoronaBP.png", sublime.HIDDEN)
-  if queueing:
-    subProcOutputQ.task_done()
+      return
+
+    status = "@@@ " in text
+    if status:
+      # Remove the last status we output (unless it's already been trimmed)
+      for region in view.get_regions('corona_status'):
+        if not region.empty():
+          view.erase(edit, view.full_line(region))
+    view.insert(edit, view.size(), text)
+
+    if max_lines > 0:
+      excess = view.rowcol(view.size())[0] - max_lines
+      if excess > 0:
+        view.erase(edit, sublime.Region(0, view.text_point(excess, 0)))
+
+    view.set_read_only(True)
+    view.show(view.size(), True)  # scroll to the end, works better on Windows
+
+    # Highlight status line and remember where it is so it can be removed later (the region
+    # moves with the text when older lines are trimmed)
+    if status:
+      line = view.rowcol(view.size())[0]
+      statusRegion = view.line(view.text_point(line-1, 0))
+      view.add_regions('corona_status', [statusRegion], "", "", sublime.HIDDEN)
+      view.sel().clear()
+      view.sel().add(statusRegion)
+      mark = [sublime.Region(view.size() - 1, view.size())]
+      if _corona_utils.SUBLIME_VERSION < 3000:
+        # Path for icons is "Packages/Theme - Default/"
+        view.add_regions('dbg', mark, "debugger", "../"+_corona_utils.PACKAGE_NAME+"/CoronaBP", sublime.HIDDEN)
+      else:
+        view.add_regions('dbg', mark, "debugger", "Packages/"+_corona_utils.PACKAGE_NAME+"/CoronaBP.png", sublime.HIDDEN)
+
+  # Make the pane's text 'text' by applying a line by line diff with what's there now and highlight
+  # the lines which have changed (rather than been added or removed, e.g. a variable's value)
+  def replaceLines(self, edit, text):
+    view = self.view
+    old = view.substr(sublime.Region(0, view.size())).splitlines(True)
+    new = text.splitlines(True)
+    try:
+      matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    except TypeError:
+      matcher = difflib.SequenceMatcher(None, old, new)  # P2.6
+    opcodes = matcher.get_opcodes()
+
+    oldStarts = line_starts(old)
+    # Working from the end means the changes don't move the text that's still to be changed
+    for tag, i1, i2, j1, j2 in reversed(opcodes):
+      if tag != 'equal':
+        view.replace(edit, sublime.Region(oldStarts[i1], oldStarts[i2]), "".join(new[j1:j2]))
+
+    newStarts = line_starts(new)
+    changed = []
+    for tag, i1, i2, j1, j2 in opcodes:
+      if tag != 'replace':
+        continue
+      for k in range(min(i2 - i1, j2 - j1)):
+        # (expanding or collapsing a table isn't a change)
+        if old[i1 + k].lstrip(" +-") != new[j1 + k].lstrip(" +-"):
+          changed.append(sublime.Region(newStarts[j1 + k], newStarts[j1 + k] + len(new[j1 + k].rstrip("\n"))))
+    view.add_regions('corona_changed', changed, "markup.changed", "", sublime.DRAW_OUTLINED)
+
+
+# The offset of the start of each line in 'lines' (and of the end of the last one)
+def line_starts(lines):
+  starts = [0]
+  for line in lines:
+    starts.append(starts[-1] + len(line))
+  return starts
+
+
+# Expand or collapse the table on the current line of the Variables pane (its elements are fetched
+# from the Simulator the first time)
+class CoronaDebuggerExpandCommand(sublime_plugin.TextCommand):
+
+  def is_enabled(self):
+    return bool(self.view.settings().get('_corona_debugger_variables'))
+
+  def run(self, edit):
+    row = self.view.rowcol(self.view.sel()[0].begin())[0]
+    node = coronaVariables.nodeAt(row)
+    if node is None or not node.isTable() or node.value == "0":
+      return
+    if node.expanded or node.children is not None:
+      node.expanded = not node.expanded
+      variables_output(coronaVariables.render())
+    elif node.expr is None:
+      debugger_status("Cannot expand " + node.name)
+    elif coronaDbg is not None and coronaDbg.isRunning():
+      coronaDbg.doCommand("expand " + node.expr)
 
 
 class CoronaSubprocessThread(threading.Thread):
@@ -903,13 +1681,52 @@ class CoronaSubprocessThread(threading.Thread):
     self.completionCallback = completionCallback
     self.window = window
     self.proc = None
+    self.outputClosed = False
+    # (don't keep Sublime Text running if something still has the output open)
+    self.daemon = True
 
   def terminate(self):
     if self.proc.poll() is None:
       self.proc.terminate()
 
+  # Stop reading the output (we're not going to see the end of it)
+  def closeOutput(self):
+    self.outputClosed = True
+    try:
+      self.proc.stdout.close()
+    except Exception as e:
+      debug("closeOutput: %s", e)
+
+  # Output is read in large chunks (as much as is available, up to SUBPROCESS_READ_SIZE) and
+  # passed on a chunk of complete lines at a time, a partial line waits for the rest of it
+  def readOutput(self, stdout):
+    decoder = codecs.getincrementaldecoder('UTF-8')(errors='replace')
+    partial = ""
+    if hasattr(stdout, 'readinto') and sys.version_info >= (3,):
+      buf = bytearray(SUBPROCESS_READ_SIZE)
+      view = memoryview(buf)
+      read = lambda: view[:stdout.readinto(buf) or 0]
+    else:
+      # Python 2's file.readinto() waits for the buffer to be filled
+      fd = stdout.fileno()
+      read = lambda: os.read(fd, SUBPROCESS_READ_SIZE)
+
+    while True:
+      chunk = read()
+      if len(chunk) == 0:
+        break
+      text = partial + decoder.decode(chunk)
+      end = text.rfind("\n") + 1
+      partial = text[end:]
+      if end > 0:
+        console_output(text[:end])
+
+    partial += decoder.decode(b"", True)
+    if partial:
+      console_output(partial)
+
   def run(self):
-    debug("Running: " + str(self.cmd))
+    debug("Running: %s", self.cmd)
     if sublime.platform() == "windows":
       closeFDs = False
     else:
@@ -917,24 +1734,22 @@ class CoronaSubprocessThread(threading.Thread):
 
     self.proc = subprocess.Popen(self.cmd, bufsize=0, close_fds=closeFDs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-    while self.proc.poll() is None:
-        try:
-          data = self.proc.stdout.readline().decode('UTF-8')
-          # this isn't the same as "print()": sys.stdout.write(data)
-          # print("Read: " + data)
-          console_output(data)
-        except IndexError as e:
-          break  # we get this when the child process has terminated
-        except Exception as e:
-          console_output("Exception reading from coprocess: "+str(e))
+    # Read until the pipe is closed rather than until the process has exited so we don't lose
+    # whatever it wrote just before it exited
+    try:
+      self.readOutput(self.proc.stdout)
+    except Exception as e:
+      if not self.outputClosed:
+        console_output("Exception reading from coprocess: "+str(e))
+    self.proc.wait()
 
     on_main_thread(lambda: self.completionCallback(self.threadID, self.window))
 
-    debug("CoronaSubprocessThread: ends (proc.poll(): " + str(self.proc.poll()) + ")")
+    debug("CoronaSubprocessThread: ends (proc.poll(): %s)", self.proc.returncode)
 
 
 def CompleteSubprocess(threadID, window):
-  debug("CompleteSubprocess: called (" + str(threadID) + ")")
+  debug("CompleteSubprocess: called (%s)", threadID)
   # debug("CompleteSubprocess: window " + str(window))
   # window.run_command("corona_debugger", {"cmd": "exit"})
 
@@ -947,7 +1762,10 @@ def RunSubprocess(cmd, window):
 
 def StopSubprocess():
   global coronaDbgThread
-  debug("StopSubprocess: " + str(coronaDbgThread))
+  debug("StopSubprocess: %s", coronaDbgThread)
   if coronaDbgThread is not None and coronaDbgThread.is_alive():
     coronaDbgThread.terminate()
-    coronaDbgThread.join()
+    coronaDbgThread.join(SUBPROCESS_STOP_TIMEOUT)
+    if coronaDbgThread.is_alive():
+      debug("StopSubprocess: output still open after %ss", SUBPROCESS_STOP_TIMEOUT)
+      coronaDbgThread.closeOutput()
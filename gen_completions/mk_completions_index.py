@@ -0,0 +1,37 @@
+#!/usr/bin/python
+#
+# Sublime Text plugin to support Corona SDK
+#
+# Copyright (c) 2013 Corona Labs Inc. A mobile development software company. All rights reserved.
+#
+# MIT License - see https://raw.github.com/coronalabs/CoronaSDK-SublimeText/master/LICENSE
+#
+# mk_completions_index.py - build the prebuilt completion index for an API file
+#
+# The index (written next to the API file made by mk_sublime_completions.py with the suffix ".idx")
+# holds everything the plugin would otherwise work out each time the docset is loaded: the
+# completion names and descriptions, the namespace buckets, the argument templates with and
+# without white space, the signatures and the character and prefix lookups.  The plugin falls back to the
+# API file if the index is missing or was built from a different version of it.
+#
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import _completion_index
+
+if len(sys.argv) != 2:
+  print("Usage: "+ sys.argv[0] + " <api-file>")
+  sys.exit(1)
+
+with open(sys.argv[1], "rb") as fh:
+  source = fh.read()
+
+index = _completion_index.CompletionIndex(json.loads(source.decode('utf-8'))['entries'])
+
+with open(sys.argv[1] + _completion_index.INDEX_SUFFIX, "wb") as fh:
+  fh.write(_completion_index.dump_index(index, source))
+
+print("{0}: indexed {1} completions".format(sys.argv[1] + _completion_index.INDEX_SUFFIX, len(index)))
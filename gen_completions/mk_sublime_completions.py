@@ -6,33 +6,110 @@
 #
 # MIT License - see https://raw.github.com/coronalabs/CoronaSDK-SublimeText/master/LICENSE
 #
+# mk_sublime_completions.py - make a Sublime completions file and an API file from raw completions
+#
+# Each line of a raw completions file (see create-completions) is parsed into an API entry: its
+# name, the namespace and member, whether it's a function, a method or a property, the arguments
+# (and which are optional), the type (the library or type the docs page is in) and the Sublime
+# trigger and contents which complete it.  The entries are checked as they're made: lines the docs
+# mangled (HTML, markdown escapes, a space instead of the tab before the type) are fixed, lines that
+# aren't an API item are dropped as are duplicates, and each of these is reported.  String library
+# functions the docs don't also have as methods get a method entry too (see string_method_line()).
+#
+# The completions file is the Sublime version of the entries, the API file is the entries
+# themselves (the plugin builds its completion index from this, see _completion_index.py).
+#
 
+import os
 import re
 import string
 import json
 import sys
 import pprint
 
-items = {
-    "scope": "source.lua",
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from _completion_index import API_FORMAT, FUNCTION, METHOD, PROPERTY
+
+_findHiddenHTML = re.compile(r'<(\w+)[^>]*display:\s*none[^>]*>.*?</\1>')
+_findHTML = re.compile(r'</?\w+[^>]*>')
+_findMarkdownEscape = re.compile(r'\\([_*`])')
+_findSpaceForTab = re.compile(r'^(\S+)\s+(\w+)$')
+_findName = re.compile(r'^[A-Za-z_][\w.]*$')
+_findStringFunction = re.compile(r'^string\.(\w+)\s*\((.*)\)\s*(\t.*)?$')
+
+
+# Undo the things the docs do to some items, returns the fixed line and what was fixed
+def clean_line(line):
+  fixes = []
+  if "<" in line:
+    cleaned = _findHTML.sub("", _findHiddenHTML.sub("", line))
+    if cleaned != line:
+      line = cleaned
+      fixes.append("HTML")
+  if "\\" in line:
+    cleaned = _findMarkdownEscape.sub("\\1", line)
+    if cleaned != line:
+      line = cleaned
+      fixes.append("markdown escape")
+  if "\t" not in line:
+    match = _findSpaceForTab.match(line)
+    if match is not None:
+      line = match.group(1) + "\t" + match.group(2)
+      fixes.append("space instead of a tab before the type")
+  return line, fixes
+
+
+# Split the arguments of a function into the required ones and the optional ones (in square
+# brackets).  Nested optional arguments are given brackets of their own ("a [, b [, c]]" is "a",
+# "[, b]" and "[, c]") and tables and parentheses are kept whole.  A missing "]" is taken to be at
+# the end.
+def split_args(argsString):
+  args = []
+  current = ""
+  depth = 0  # square brackets we're in
+  nesting = 0  # braces and parentheses we're in
 
-    "completions": [ ]
-}
+  def add(text):
+    if depth == 0:
+      if text.strip() != "":
+        args.append(text)
+    elif text.strip(" ,") != "":
+      args.append("[" + text + "]")
 
-if len(sys.argv) != 2:
-  print("Usage: "+ sys.argv[0] + " <raw-completions>")
-  sys.exit(1)
+  for ch in argsString:
+    if ch in "{(":
+      nesting += 1
+    elif ch in "})" and nesting > 0:
+      nesting -= 1
+    elif nesting == 0 and ch == "[":
+      add(current.rstrip())
+      current = ""
+      depth += 1
+      continue
+    elif nesting == 0 and ch == "]" and depth > 0:
+      add(current)
+      current = ""
+      depth -= 1
+      continue
+    elif nesting == 0 and ch == "," and depth == 0:
+      add(current)
+      current = ""
+      continue
+    current += ch
+  add(current)
+  return args
 
-fh = open(sys.argv[1])
 
-for line in fh.readlines():
-  typeDesc = "unknown"
+# The API entry for a (clean) line of a raw completions file
+def parse_line(line):
+  typeDesc = None
+  kind = PROPERTY
   line = line.strip()
-  # print(line)
   if line.find(':') != -1:
     # We have a type member, since we can't know what the object is called,
     # complete from the semi-colon only
     line = line.partition(':')[2]
+    kind = METHOD
 
   if line.find("\t") != -1:
     # We have a type description after a tab
@@ -41,33 +118,157 @@ for line in fh.readlines():
 
   argListMatch = re.search("\((.*)\)", line)
 
+  args = []
   if argListMatch != None:
     argsString = argListMatch.groups()[0]
-    typeDesc = argsString.strip() if typeDesc is "unknown" else typeDesc
-    funcName = line.replace("("+argsString+")", "")
-    funcName = funcName.strip()
-    args = re.findall("(\[.*?\]|[^\[,]*)", argsString)
-    # print("   funcName", funcName)
-    # print("   argsString", argsString)
-    # print("   args", args)
+    name = line.replace("("+argsString+")", "").strip()
+    # create-completions removes "object:" so a function of a type (their names are capitalized,
+    # e.g. "DisplayObject") that isn't in a namespace is a method too
+    if kind != METHOD and ("." in name or typeDesc is None or not typeDesc[:1].isupper()):
+      kind = FUNCTION
+    else:
+      kind = METHOD
     argCount = 1
     stCompArgs = ""
-    for arg in args:
+    for arg in split_args(argsString):
       arg = arg.strip()
-      if arg == "":
-        continue
+      args.append({"name": arg.strip("[], "), "optional": arg.startswith("[")})
       # if the arg is not optional and includes a comma, add a comma
       if not arg.startswith("[,"):
         stCompArgs += ","
       stCompArgs += " ${"+str(argCount)+":"+arg+"}"
       argCount += 1
     stCompArgs = stCompArgs.lstrip(",");
-    # print({"trigger": "{0}()\t{1}".format(funcName, typeDesc), "contents": "{0}({1} )".format(funcName, stCompArgs)})
-    items['completions'].append({"trigger": "{0}()\t{1}".format(funcName, typeDesc), "contents": "{0}({1} )".format(funcName, stCompArgs)})
+    trigger = "{0}()\t{1}".format(name, typeDesc if typeDesc is not None else argsString.strip())
+    contents = "{0}({1} )".format(name, stCompArgs)
   else:
-    items['completions'].append({"trigger": "{0}\t{1}".format(line, typeDesc), "contents": line})
+    name = line
+    kind = PROPERTY
+    trigger = "{0}\t{1}".format(name, typeDesc if typeDesc is not None else "unknown")
+    contents = name
+
+  return {
+    "name": name,
+    "namespace": name.partition(".")[0] if "." in name else "",
+    "member": name.rpartition(".")[2],
+    "kind": kind,
+    "args": args,
+    "type": typeDesc,
+    "trigger": trigger,
+    "contents": contents,
+  }
+
+
+# Functions in the string library can be called as methods of strings ("s:find(pattern)" is
+# "string.find(s, pattern)"), returns the line of the method for a (clean) line of a string
+# function, None if it isn't one or has no string argument
+def string_method_line(line):
+  match = _findStringFunction.match(line.strip())
+  if match is None:
+    return None
+  args = split_args(match.group(2))
+  if not args or args[0].strip().startswith("["):
+    return None
+  argsString = ""
+  for arg in args[1:]:
+    arg = arg.strip()
+    argsString += (" " if arg.startswith("[,") or argsString == "" else ", ") + arg
+  return "s:{0}({1} ){2}".format(match.group(1), argsString, match.group(3) or "")
+
+
+# What's wrong with an entry as (problem, drop it), None if nothing is
+def malformed(entry, line):
+  if not _findName.match(entry["name"]):
+    return ("not an API name", True)
+  if line.count("(") != line.count(")"):
+    return ("unbalanced parentheses", True)
+  if line.count("[") != line.count("]"):
+    # usually a missing "]" for nested optional arguments, split_args() takes it to be at the end
+    return ("unbalanced square brackets, a missing \"]\" is taken to be at the end", False)
+  return None
+
+
+# The API entries for the lines of a raw completions file and a list of the problems found in them
+def make_api(lines):
+  entries = []
+  problems = []
+  seen = set()
+  cleanedLines = []
+  for line in lines:
+    line = line.strip()
+    if line == "":
+      continue
+    cleaned, fixes = clean_line(line)
+    entry = parse_line(cleaned)
+    problem = malformed(entry, cleaned)
+    if problem is not None and problem[1]:
+      problems.append("'{0}': {1}, dropped".format(line, problem[0]))
+      continue
+    if problem is not None:
+      problems.append("'{0}': {1}, kept".format(line, problem[0]))
+    if fixes:
+      problems.append("'{0}': {1}, fixed".format(line, ", ".join(fixes)))
+    key = (entry["trigger"], entry["contents"])
+    if key in seen:
+      problems.append("'{0}': duplicate, dropped".format(line))
+      continue
+    seen.add(key)
+    entries.append(entry)
+    cleanedLines.append(cleaned)
+
+  # Add the methods of the string functions the docs only have as functions (after the functions)
+  methods = set(entry["name"] for entry in entries if entry["kind"] == METHOD and entry["type"] == "string")
+  withMethods = []
+  for entry, cleaned in zip(entries, cleanedLines):
+    withMethods.append(entry)
+    if entry["kind"] == FUNCTION and entry["namespace"] == "string" and entry["member"] not in methods:
+      methodLine = string_method_line(cleaned)
+      if methodLine is not None:
+        withMethods.append(parse_line(methodLine))
+  return withMethods, problems
+
+
+# The Sublime completions for API entries
+def make_completions(entries):
+  items = {
+      "scope": "source.lua",
+
+      "completions": [ ]
+  }
+
+  for entry in entries:
+    items['completions'].append({"trigger": entry["trigger"], "contents": entry["contents"]})
+
+  return items
+
+
+# The string replacements reduce the indented JSON to one item per line (the separators are given
+# so Python 3 formats it the same way as Python 2)
+def format_completions(items):
+  return json.dumps(items, indent = 2, separators = (', ', ': ')).replace('{\n', '{').replace('", \n', '", ').replace('"\n', '"').replace('  ', ' ')
+
+
+# The API file for API entries, one entry per line (so diffs of it are readable)
+def format_api(entries):
+  lines = [json.dumps(entry, sort_keys = True, separators = (', ', ': ')) for entry in entries]
+  return '{"format": ' + str(API_FORMAT) + ', "entries": [\n' + ",\n".join(lines) + '\n]}'
+
+
+if __name__ == "__main__":
+  if len(sys.argv) not in [2, 3]:
+    print("Usage: "+ sys.argv[0] + " <raw-completions> [<api-file>]")
+    sys.exit(1)
+
+  with open(sys.argv[1]) as fh:
+    entries, problems = make_api(fh.readlines())
+
+  for problem in problems:
+    sys.stderr.write(sys.argv[1] + ": " + problem + "\n")
+
+  if len(sys.argv) == 3:
+    with open(sys.argv[2], "w") as fh:
+      fh.write(format_api(entries) + "\n")
 
-# pp = pprint.PrettyPrinter(indent = 2)
-# pp.pprint(items)
-# The string replacements reduce the indented JSON to one item per line
-print(json.dumps(items, indent = 2).replace('{\n', '{').replace('", \n', '", ').replace('"\n', '"').replace('  ', ' '))
+  # pp = pprint.PrettyPrinter(indent = 2)
+  # pp.pprint(entries)
+  print(format_completions(make_completions(entries)))
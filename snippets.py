@@ -12,8 +12,11 @@ import json
 import threading
 import re
 import zipfile
-import tempfile
-from xml.dom import minidom
+import hashlib
+import io
+import shutil
+import zlib
+from xml.sax.saxutils import unescape
 
 try:
   from . import completions  # P3
@@ -26,31 +29,114 @@ except:
   import _corona_utils  # P2
 
 
-def XMLGetText(nodelist):
-  parts = []
-  for node in nodelist:
-    if node.nodeType == node.TEXT_NODE:
-      parts.append(node.data)
-  return ''.join(parts)
+# The snippet index (in the package's User directory) remembers the modification time, size and
+# description of each snippet file so only new or changed snippets are read when the menu is built
+SNIPPET_INDEX = "snippets.index"
+SNIPPET_INDEX_FORMAT = 1
+
+_findDescription = re.compile(r'<description>\s*(?:<!\[CDATA\[(.*?)\]\]>|(.*?))\s*</description>', re.S)
+
+
+# The <description> of a snippet file (None if it doesn't have one), we just look for the element
+# rather than parsing the whole file
+def SnippetDescription(path):
+  with open(path, "rb") as fd:
+    text = fd.read().decode("utf-8", "replace")
+  match = _findDescription.search(text)
+  if match is None:
+    return None
+  if match.group(1) is not None:
+    return match.group(1)
+  return unescape(match.group(2), {"&quot;": '"', "&apos;": "'"})
+
+
+def FileDigest(path):
+  try:
+    with open(path, "rb") as fd:
+      return hashlib.md5(fd.read()).hexdigest()
+  except (IOError, OSError):
+    return None
+
+
+# The CRC of each snippet we've extracted from snippets.zip (as it was in the ZIP file) is kept in
+# this file in the Snippets directory so we can tell which snippets have changed when the package is
+# upgraded and which the user has changed since they were extracted
+SNIPPET_MANIFEST = ".snippets-manifest"
+
+# The CRCs of every version of each snippet we've shipped in snippets.zip, in the package's
+# snippets.shipped.  Installs from before the manifest existed don't have one so these tell us
+# which of their snippets are ours to replace.  When snippets.zip changes, add the CRCs of the
+# snippets it had before the change.
+SNIPPETS_SHIPPED = "snippets.shipped"
+
+
+def FileCRC(path):
+  crc = 0
+  with open(path, "rb") as fd:
+    while True:
+      data = fd.read(65536)
+      if not data:
+        break
+      crc = zlib.crc32(data, crc)
+  return crc & 0xffffffff
+
+
+# Extract the snippets in 'zfile' which are new or have changed since they were last extracted to
+# 'destDir'.  Snippets the user has edited or deleted are left alone.  'shipped' maps the names of
+# snippets to the CRCs of the versions we've shipped (see SNIPPETS_SHIPPED).  Returns the number of
+# files written.
+def ExtractSnippets(zfile, destDir, shipped=None):
+  manifestPath = os.path.join(destDir, SNIPPET_MANIFEST)
+  try:
+    with open(manifestPath, "r") as fd:
+      manifest = json.load(fd)
+  except (IOError, OSError, ValueError):
+    manifest = {}
+
+  written = 0
+  newManifest = {}
+  for info in zfile.infolist():
+    name = info.filename
+    path = os.path.join(destDir, *name.split("/"))
+    if name.endswith("/"):
+      if not os.path.isdir(path):
+        os.makedirs(path)
+      continue
+
+    extracted = manifest.get(name)
+    newManifest[name] = extracted
+    if extracted == info.CRC:
+      continue  # unchanged since we last extracted it
+    if os.path.exists(path):
+      # Leave it alone if the user has changed it (if we've never extracted it, e.g. the manifest is
+      # new, it's only ours if it's the same as one we've shipped)
+      crc = FileCRC(path)
+      if crc == info.CRC:
+        newManifest[name] = info.CRC
+        continue
+      if extracted is None:
+        if shipped is None or crc not in shipped.get(name, ()):
+          continue
+      elif crc != extracted:
+        continue
+    elif extracted is not None:
+      continue  # the user has deleted it
 
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    source = zfile.open(info)
+    try:
+      with open(path, "wb") as fd:
+        shutil.copyfileobj(source, fd)
+    finally:
+      source.close()
+    newManifest[name] = info.CRC
+    written += 1
 
-def UnZIPToDir(zipFilePath, destDir):
-  zfile = zipfile.ZipFile(zipFilePath)
-  for name in zfile.namelist():
-    (dirName, fileName) = os.path.split(name)
-    if fileName == '':
-      # directory
-      newDir = os.path.join(destDir, dirName)
-      if not os.path.exists(newDir):
-        os.makedirs(newDir)
-    else:
-      # file
-      path = os.path.join(destDir, name)
-      # print("Unzip: " + path)
-      fd = open(path, 'wb')
-      fd.write(zfile.read(name))
-      fd.close()
-  zfile.close()
+  if newManifest != manifest:
+    with open(manifestPath, "w") as fd:
+      json.dump(newManifest, fd)
+  return written
 
 
 class CoronaSnippetFolderIndexer(threading.Thread):
@@ -59,6 +145,8 @@ class CoronaSnippetFolderIndexer(threading.Thread):
 
   def __init__(self):
     threading.Thread.__init__(self)
+    self._index = {}  # snippet path -> [mtime, size, description] from the last run
+    self._newIndex = {}  # the same for the snippets we've seen on this run
 
   def run(self):
 
@@ -71,26 +159,42 @@ class CoronaSnippetFolderIndexer(threading.Thread):
     if not os.path.exists(self._snippets_dir):
       os.makedirs(self._snippets_dir)
       print(_corona_utils.PACKAGE_NAME + ": Extracting snippets ...")
+
+    # Bring the snippets up to date with the ones in the package (this only writes anything the
+    # first time or after the package has been upgraded)
+    try:
+      # In ST3 our ZIP file is not on the filesystem, it's in our package
+      zfile = zipfile.ZipFile(io.BytesIO(sublime.load_binary_resource(_corona_utils.ST_PACKAGE_PATH + "snippets.zip")))
+    except:
+      # We're on ST2 and the ZIP file is just a file in our package directory
+      zfile = zipfile.ZipFile(os.path.join(_corona_utils.PACKAGE_DIR, "snippets.zip"))
+    try:
+      shipped = json.loads(sublime.load_resource(_corona_utils.ST_PACKAGE_PATH + SNIPPETS_SHIPPED))
+    except:
       try:
-        # In ST3 our ZIP file is not on the filesystem, it's in our package so we have to extract
-        # it and unzip from there (to work on Windows the temp file must be closed before it can
-        # be reopened to be unzipped)
-        zip_bytes = sublime.load_binary_resource(_corona_utils.ST_PACKAGE_PATH + "snippets.zip")
-        with tempfile.NamedTemporaryFile(suffix = ".zip", delete=False) as tempzip:
-          tempzip.write(zip_bytes)
-          tempzip.close()
-          UnZIPToDir(tempzip.name, self._snippets_dir)
-          os.remove(tempzip.name)
-      except:
-        # We're on ST2 and the ZIP file is just a file in our package directory
-        UnZIPToDir(os.path.join(_corona_utils.PACKAGE_DIR, "snippets.zip"), self._snippets_dir)
+        with open(os.path.join(_corona_utils.PACKAGE_DIR, SNIPPETS_SHIPPED), "r") as fd:
+          shipped = json.load(fd)
+      except (IOError, OSError, ValueError):
+        shipped = None
+    try:
+      written = ExtractSnippets(zfile, self._snippets_dir, shipped)
+      if written:
+        _corona_utils.debug("Extracted " + str(written) + " snippets")
+    except (IOError, OSError, zipfile.BadZipfile) as e:
+      print(_corona_utils.PACKAGE_NAME + ": Failed to extract snippets: " + str(e))
+    finally:
+      zfile.close()
 
     snippetMenuArray = []
     snippetJSON = ""
 
     if os.path.isdir(self._snippets_dir):
+      indexPath = os.path.join(_corona_utils.PACKAGE_USER_DIR, SNIPPET_INDEX)
+      self._index = self.loadIndex(indexPath)
       snippetMenuArray = self.addDirectory(self._snippets_dir)
       snippetJSON = json.dumps(snippetMenuArray, indent=4, separators=(',', ': '))
+      if self._newIndex != self._index:
+        self.saveIndex(indexPath)
 
     if snippetJSON == "":
       print(_corona_utils.PACKAGE_NAME + ": Failed to build Snippets menu")
@@ -116,17 +220,53 @@ class CoronaSnippetFolderIndexer(threading.Thread):
 
     menus = menus.replace("$corona_package_name", _corona_utils.PACKAGE_NAME)
     menus = menus.replace("$corona_snippets", snippetJSON)
+    menus = "// Generated file - do not edit - modify 'Main.sublime-menu.template' instead\n" + menus
+
+    # Writing the menu makes Sublime Text reload it so only do that if it's changed
+    menuPath = os.path.join(_corona_utils.PACKAGE_DIR, "Main.sublime-menu")
+    menuBytes = menus if isinstance(menus, bytes) else menus.encode('utf-8')  # (P2 strings are bytes)
+    if FileDigest(menuPath) == hashlib.md5(menuBytes).hexdigest():
+      return
 
     if not os.path.exists(_corona_utils.PACKAGE_DIR):
       os.makedirs(_corona_utils.PACKAGE_DIR)
-    if _corona_utils.SUBLIME_VERSION < 3000:
-      with open(os.path.join(_corona_utils.PACKAGE_DIR, "Main.sublime-menu"), "w") as fd:
-          fd.write("// Generated file - do not edit - modify 'Main.sublime-menu.template' instead\n")
-          fd.write(menus)
-    else:  # ST3/P3
-      with open(os.path.join(_corona_utils.PACKAGE_DIR, "Main.sublime-menu"), "w", encoding='utf-8') as fd:
-          fd.write("// Generated file - do not edit - modify 'Main.sublime-menu.template' instead\n")
-          fd.write(menus)
+    with open(menuPath, "wb") as fd:
+      fd.write(menuBytes)
+
+  def loadIndex(self, path):
+    try:
+      with open(path, "r") as fd:
+        index = json.load(fd)
+      if index.get('format') == SNIPPET_INDEX_FORMAT:
+        return index['files']
+    except (IOError, OSError, ValueError, KeyError):
+      pass
+    return {}
+
+  def saveIndex(self, path):
+    try:
+      with open(path, "w") as fd:
+        json.dump({'format': SNIPPET_INDEX_FORMAT, 'files': self._newIndex}, fd)
+    except (IOError, OSError) as e:
+      print(_corona_utils.PACKAGE_NAME + ": Failed to save snippet index: " + str(e))
+
+  # The description of a snippet file, from the index if the file hasn't changed since it was read
+  def describe(self, path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    entry = self._index.get(path)
+    if entry is None or entry[0] != st.st_mtime or entry[1] != st.st_size:
+      try:
+        desc = SnippetDescription(path)
+      except (IOError, OSError):
+        desc = None
+      if desc is None:
+        print(_corona_utils.PACKAGE_NAME + ": No description in " + path)
+      entry = [st.st_mtime, st.st_size, desc]
+    self._newIndex[path] = entry
+    return entry[2]
 
   def addDirectory(self, path):
     jsonArray = []
@@ -139,17 +279,11 @@ class CoronaSnippetFolderIndexer(threading.Thread):
       if os.path.isdir(realpath):
         jsonArray.append({"caption": pathname, "children": self.addDirectory(realpath)})
       else:
-        # Parse XML snippet file to get the "Description"
+        # Get the "Description" from the XML snippet file
         if realpath.endswith(".sublime-snippet"):
-          # _corona_utils.debug("Parsing: " + realpath)
-          try:
-            xmldoc = minidom.parse(realpath)
-          except:
-            print(_corona_utils.PACKAGE_NAME + ": Invalid XML in " + realpath)
-          else:
-            desc = XMLGetText(xmldoc.getElementsByTagName('description')[0].childNodes)
-            if desc is None:
-              desc = path
+          desc = self.describe(realpath)
+          if desc is None:
+            desc = pathname
         else:
           desc = pathname
 
@@ -169,8 +303,22 @@ if _corona_utils.SUBLIME_VERSION < 3000:
   plugin_loaded()
 
 
+# The contents of the plain text snippet files, path -> (mtime, contents), so they're only read
+# again if they change
+_snippetContents = {}
+
+
+def SnippetContents(path):
+  mtime = os.path.getmtime(path)
+  cached = _snippetContents.get(path)
+  if cached is None or cached[0] != mtime:
+    with open(path, "r") as fd:
+      cached = (mtime, fd.read().strip())
+    _snippetContents[path] = cached
+  return cached[1]
+
+
 class CoronaSnippetCommand(sublime_plugin.TextCommand):
-  _comps = None
 
   def run(self, edit, **args):
 
@@ -179,13 +327,12 @@ class CoronaSnippetCommand(sublime_plugin.TextCommand):
     else:
       trigger = args['file']
 
-    if self._comps is None:
-      completions.CoronaCompletions.initialize()
-      self._comps = completions.CoronaCompletions._completions
+    # This also picks up any change to the docset
+    completions.CoronaCompletions.initialize()
+    index = completions.CoronaCompletions._index
 
     # print("CoronaSnippetCommand:")
-    # print(str(self._comps))
-    # print(str(len(self._comps['completions'])) + " completions available")
+    # print(str(len(index)) + " completions available")
 
     # print("trigger: " + trigger)
     if trigger.endswith(".sublime-snippet"):
@@ -198,11 +345,10 @@ class CoronaSnippetCommand(sublime_plugin.TextCommand):
       self.view.run_command("insert_snippet", {"name": trigger})
     else:
       # Find a completion keyed by the contents of the snippet file
-      with open(trigger, "r") as fd:
-        lookup = fd.read().strip()
+      lookup = SnippetContents(trigger)
 
-      key = [key for key, item in enumerate(self._comps['completions']) if item['trigger'].lower().startswith(lookup.lower())]
-      if key is not None and len(key) != 0:
-        self.view.run_command("insert_snippet", {"contents": self._comps['completions'][key[0]]['contents']})
+      cid = index.find_trigger(lookup)
+      if cid is not None:
+        self.view.run_command("insert_snippet", {"contents": index.contents[cid]})
       else:
         self.view.run_command('insert', {'characters': lookup})